@@ -2,13 +2,20 @@ import argparse
 import json
 import os
 import datetime
+import random
+import time
 
-from simplecoin import create_manage_app, db, currencies, powerpools, redis_conn
-from simplecoin.scheduler import SchedulerCommand
+from simplecoin import (create_manage_app, db, currencies, powerpools,
+                        redis_conn, chains, cache)
+from simplecoin.scheduler import (SchedulerCommand, _distributor,
+                                  _int_distributor)
 from simplecoin.models import (Transaction, UserSettings, Credit, ShareSlice,
-                               DeviceSlice, Block, CreditExchange)
+                               DeviceSlice, Block, CreditExchange,
+                               PoolShareSlice)
+from simplecoin.utils import pool_rollup_ready, encode_entries
 
 from urlparse import urlparse
+from decimal import Decimal
 from flask import current_app, _request_ctx_stack
 from flask.ext.migrate import stamp
 from flask.ext.script import Manager, Shell, Server
@@ -187,6 +194,134 @@ def import_device_slices(input):
             print("{} inserted!".format(i))
 
 
+@manager.option('-ds', '--dont-simulate', default=False, action="store_true")
+@manager.option('-e', '--encoding', default=None)
+def reencode_slices(encoding, dont_simulate):
+    """ Re-encodes every compressed share slice that isn't stored with the
+    given encoding, slice_encoding by default. Raw (uncompressed) slices are
+    left to compress_slices. """
+    encoding = encoding or current_app.config['slice_encoding']
+    for chain in chains.itervalues():
+        last_index = redis_conn.get("chain_{}_slice_index".format(chain.id))
+        if last_index is None:
+            continue
+
+        empty = 0
+        converted = 0
+        original_size = 0
+        encoded_size = 0
+        # Simulated runs can't intern users since that writes their ids, so
+        # users without one are given local ids following the real ones
+        user_ids = {}
+        user_count = int(redis_conn.get(
+            "chain_{}_user_count".format(chain.id)) or 0)
+        for batch_start in xrange(int(last_index), 0, -chain.slice_batch_size):
+            indexes = range(batch_start,
+                            max(batch_start - chain.slice_batch_size, 0), -1)
+            slices = dict(chain._fetch_slices(indexes))
+            for index in indexes:
+                slc = slices.get(index)
+                if slc is None:
+                    empty += 1
+                    continue
+                empty = 0
+                if slc['encoding'] in ("colon_list", encoding):
+                    continue
+
+                entries = chain.decode_slice(slc)
+                if dont_simulate or encoding != "interned":
+                    data, new_encoding = chain.encode_slice(entries, encoding)
+                else:
+                    users = list(set(user for user, _ in entries
+                                     if user not in user_ids))
+                    if users:
+                        ids = redis_conn.hmget(
+                            "chain_{}_user_ids".format(chain.id), users)
+                        for user, user_id in zip(users, ids):
+                            if user_id is None:
+                                user_id = user_count
+                                user_count += 1
+                            user_ids[user] = int(user_id)
+                    data, new_encoding, _ = encode_entries(entries, encoding,
+                                                           user_ids)
+                original_size += len(slc['data'])
+                encoded_size += len(data)
+                converted += 1
+                key = "chain_{}_slice_{}".format(chain.id, index)
+                if not dont_simulate:
+                    current_app.logger.info(
+                        "Would re-encode {} from {} to {}"
+                        .format(key, slc['encoding'], new_encoding))
+                    continue
+
+                # Write to a temporary key and then atomically replace the
+                # old slice, like compress_slices does
+                slc.update(data=data, encoding=new_encoding)
+                redis_conn.hmset(key + "_reencoded", slc)
+                redis_conn.rename(key + "_reencoded", key)
+
+            # Same end of live slices detection as compress_slices
+            if empty >= 20:
+                break
+
+        current_app.logger.info(
+            "Re-encoded {:,} slices on chain {}. start_size: {:,}; "
+            "end_size: {:,}; ratio: {}"
+            .format(converted, chain.id, original_size, encoded_size,
+                    float(original_size) / (encoded_size or 1)))
+
+
+@manager.option('-r', '--rounds', type=int, default=5)
+@manager.option('-u', '--users', type=int, default=5000)
+def bench_distributor(users, rounds):
+    """ Compares the speed of the Decimal and integer distributor engines on
+    a block split among the given number of users """
+    amount = Decimal("25.01234567")
+    splits = {"user{}".format(i): Decimal(random.randint(1, 2 ** 24)) / 64
+              for i in xrange(users)}
+
+    results = {}
+    for name, engine in [("decimal", _distributor), ("integer", _int_distributor)]:
+        timings = []
+        for i in xrange(rounds):
+            t = time.time()
+            results[name] = engine(amount, splits.copy(),
+                                   scale=current_app.MAX_DECIMALS)
+            timings.append(time.time() - t)
+        print("{} engine: best {:,.2f}ms, average {:,.2f}ms over {} rounds"
+              .format(name, min(timings) * 1000,
+                      sum(timings) * 1000 / rounds, rounds))
+
+    if results["decimal"] != results["integer"]:
+        print("Engines gave different results!")
+
+
+@manager.command
+def partition_slices():
+    """ Converts the share and device slice tables to partitioned storage.
+    Set slice_partitioning = true once this is done. """
+    if db.engine.dialect.name != "postgresql":
+        print("Partitioned slice storage requires PostgreSQL")
+        return
+    for cls in (ShareSlice, DeviceSlice):
+        cls.partition_table(current_app.config['slice_partition_ahead'])
+    db.session.commit()
+
+
+@manager.command
+def rebuild_pool_slices():
+    """ Regenerates the pool share rollup table from the share slices """
+    PoolShareSlice.query.delete()
+    query = ShareSlice.query.filter(
+        ShareSlice.user.in_(("pool", "pool_currency")))
+    columns = ['time', 'user', 'worker', 'algo', 'share_type', 'span', 'value']
+    rows = [{col: getattr(slc, col) for col in columns} for slc in query]
+    PoolShareSlice.bulk_upsert(PoolShareSlice.from_share_slices(rows))
+    db.session.commit()
+    cache.delete_memoized(pool_rollup_ready)
+    print("Rebuilt pool share rollups from {:,} slices".format(len(rows)))
+
+
 @manager.command
 def dump_effective_config():
     import pprint
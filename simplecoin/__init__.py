@@ -225,7 +225,8 @@ def create_app(mode, configs=None, log_level=None, **kwargs):
 
         stage_tasks = set(["cache_profitability", "leaderboard",
                            "server_status", "update_network",
-                           "cache_user_donation", "update_online_workers"])
+                           "cache_user_donation", "update_online_workers",
+                           "poll_monitors"])
         for task_config in app.config['tasks']:
             if not task_config.get('enabled', False):
                 continue
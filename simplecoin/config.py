@@ -5,16 +5,18 @@ import bz2
 import time
 import toml
 import copy
+import threading
 
+from multiprocessing.pool import ThreadPool
 from flask import current_app
-from cryptokit.rpc import CoinserverRPC
+from cryptokit.rpc import CoinserverRPC, CoinRPCException
 from cryptokit.base58 import address_version
 from decimal import Decimal as dec
 
 from . import models as m
 from . import (redis_conn, chains, powerpools, locations, algos, global_config,
                currencies)
-from .utils import time_format
+from .utils import time_format, encode_entries, unpack_slice, scan_keys
 from .exceptions import (ConfigurationException, RemoteException,
                          InvalidAddressException)
 
@@ -257,6 +259,39 @@ class Currency(ConfigObject):
         address_version(pool_payout['address'])
         return pool_payout
 
+    def coinserv_batch(self, calls, timeout=None):
+        """ Sends a list of (method, params) calls to the coinserver in a
+        single JSON-RPC batch request. Returns a (result, error) pair for
+        each call in the same order, where error is a CoinRPCException if the
+        call failed. Raises RemoteException if the whole request fails,
+        including when the coinserver takes longer than its configured
+        timeout, or `timeout` seconds if it has none, to respond. """
+        cfg = self.coinserv.config
+        timeout = cfg.get('timeout', timeout)
+        url = "http://{address}:{port}/".format(**cfg)
+        payload = [dict(version="1.1", id=i, method=method, params=params)
+                   for i, (method, params) in enumerate(calls)]
+        try:
+            ret = requests.post(url, data=json.dumps(payload),
+                                auth=(cfg['username'], cfg['password']),
+                                headers={'content-type': 'application/json'},
+                                timeout=timeout)
+            responses = ret.json()
+        except (requests.RequestException, ValueError) as e:
+            raise RemoteException("Batch request to {} coinserver failed: {}"
+                                  .format(self.key, e))
+        if not isinstance(responses, list):
+            raise RemoteException("Batch request to {} coinserver failed: {}"
+                                  .format(self.key, responses))
+
+        results = [(None, CoinRPCException("No response"))] * len(calls)
+        for response in responses:
+            if response.get('error'):
+                results[response['id']] = (None, CoinRPCException(response['error']))
+            else:
+                results[response['id']] = (response['result'], None)
+        return results
+
 
 class CurrencyKeeper(Keeper):
     type_map = dict(default=Currency)
@@ -367,6 +402,8 @@ class Chain(ConfigObject):
     defaults = dict(block_bonus="0", currencies=[], safety_margin=2)
     max_indexes = 1000
     min_index = 0
+    # How many slice keys to request from redis in a single pipeline
+    slice_batch_size = 50
 
     def __init__(self, bootstrap):
         bootstrap['_algo'] = bootstrap.pop('algo')
@@ -374,6 +411,8 @@ class Chain(ConfigObject):
         bootstrap['key'] = int(bootstrap['key'])
         ConfigObject.__init__(self, bootstrap)
         self.id = self.key
+        # Cache of interned user ids -> users. See lookup_user_ids
+        self._user_names = {}
 
         assert isinstance(self.fee_perc, basestring)
         assert isinstance(self.block_bonus, basestring)
@@ -388,11 +427,607 @@ class Chain(ConfigObject):
     def algo(self):
         return algos[self._algo]
 
-    def calc_shares(self, block_payout):
+    def calc_shares(self, block_payout, window=None):
         """ Pass a block_payout object with only chain ID and blockhash
-        populated and compute share amounts """
+        populated and compute share amounts. `window` can be passed if it was
+        already computed with share_window, in which case no database access
+        is needed. """
+        if window is None:
+            window = self.share_window(block_payout)
+        return self._calc_shares(**window)
+
+    def share_window(self, block_payout):
+        """ Returns the arguments to _calc_shares that define which slices
+        pay out the given block_payout """
         raise NotImplementedError
 
+    def _fetch_slices(self, indexes):
+        """ Retrieves the slices at the given indexes using two pipelined
+        round trips: one to learn the key types and one to fetch all the data.
+        Returns a list of (index, slice) tuples for slices that exist, in the
+        order the indexes were given. """
+        keys = ["chain_{}_slice_{}".format(self.id, index) for index in indexes]
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        key_types = pipe.execute()
+
+        for key, key_type in zip(keys, key_types):
+            if key_type == "list":
+                pipe.lrange(key, 0, -1)
+            elif key_type == "hash":
+                pipe.hgetall(key)
+            elif key_type != "none":
+                raise Exception("Unexpected slice key type {}".format(key_type))
+        results = iter(pipe.execute())
+
+        slices = []
+        for index, key_type in zip(indexes, key_types):
+            if key_type == "list":
+                slices.append((index, dict(encoding="colon_list",
+                                           data=next(results))))
+            elif key_type == "hash":
+                slices.append((index, next(results)))
+        return slices
+
+    def intern_users(self, users):
+        """ Returns a dictionary mapping each of the given users to its chain
+        wide integer id, assigning new ids as needed. """
+        users = list(set(users))
+        if not users:
+            return {}
+        ids_key = "chain_{}_user_ids".format(self.id)
+        ids = dict(zip(users, redis_conn.hmget(ids_key, users)))
+
+        new = [user for user, user_id in ids.iteritems() if user_id is None]
+        if new:
+            # Reserve a block of ids for all the new users at once
+            last = redis_conn.incr("chain_{}_user_count".format(self.id),
+                                   len(new))
+            pipe = redis_conn.pipeline()
+            for user, user_id in zip(new, xrange(last - len(new), last)):
+                pipe.hsetnx(ids_key, user, user_id)
+                pipe.hset("chain_{}_user_names".format(self.id), user_id, user)
+            pipe.execute()
+            # Another process may have interned some of the same users first,
+            # in which case their id wins and ours goes unused
+            ids.update(zip(new, redis_conn.hmget(ids_key, new)))
+
+        return {user: int(user_id) for user, user_id in ids.iteritems()}
+
+    def lookup_user_ids(self, user_ids):
+        """ Maps chain wide user ids back to users. Ids never change once
+        assigned, so they're cached for the life of the process and only
+        unknown ids cost a round trip. """
+        names = self._user_names
+        missing = [user_id for user_id in user_ids if user_id not in names]
+        if missing:
+            found = redis_conn.hmget("chain_{}_user_names".format(self.id),
+                                     missing)
+            for user_id, user in zip(missing, found):
+                if user is None:
+                    raise Exception("Unknown user id {} on chain {}"
+                                    .format(user_id, self.id))
+                names[user_id] = user
+        return names
+
+    def encode_slice(self, entries, encoding):
+        """ Serializes a list of (user, shares) tuples for storage in a
+        compressed slice. Returns the data and the encoding that was actually
+        used, since slices that can't be packed fall back to bz2json. """
+        user_ids = None
+        if encoding == "interned":
+            user_ids = self.intern_users(user for user, _ in entries)
+        data, used, error = encode_entries(entries, encoding, user_ids)
+        if error is not None:
+            current_app.logger.warn(
+                "Unable to pack slice for chain {}, using bz2json: {}"
+                .format(self.id, error))
+        return data, used
+
+    def decode_slice(self, slc):
+        """ Turns a fetched slice into a list of (user, shares) tuples """
+        if slc['encoding'] == "packed":
+            return unpack_slice(slc['data'])
+        elif slc['encoding'] == "interned":
+            return unpack_slice(slc['data'], self.lookup_user_ids)
+        elif slc['encoding'] == "bz2json":
+            serialized = bz2.decompress(slc['data'])
+            return json.loads(serialized, use_decimal=True)
+        elif slc['encoding'] == "colon_list":
+            # Parse the list into proper python representation
+            entries = []
+            for entry in slc['data']:
+                user, shares = entry.split(":")
+                shares = dec(shares)
+                entries.append((user, shares))
+            return entries
+        raise Exception("Unsupported slice data encoding {}"
+                        .format(slc['encoding']))
+
+    # The slice registry is a sorted set of every known slice on the chain,
+    # scored by index. Members are "index:state:total_shares", where state is
+    # "raw" for uncompressed lists and "compressed" for hashes. Raw indexes
+    # are also kept in a set so they can be found without walking the
+    # registry.
+    @property
+    def _registry_key(self):
+        return "chain_{}_registry".format(self.id)
+
+    @property
+    def _raw_key(self):
+        return "chain_{}_raw_slices".format(self.id)
+
+    def _queue_slice_state(self, pipe, index, state, total_shares=0):
+        pipe.zremrangebyscore(self._registry_key, index, index)
+        pipe.zadd(self._registry_key,
+                  **{"{}:{}:{}".format(index, state, total_shares): index})
+        if state == "raw":
+            pipe.sadd(self._raw_key, index)
+        else:
+            pipe.srem(self._raw_key, index)
+
+    def mark_compressed(self, index, total_shares):
+        """ Records that a raw slice has been compressed """
+        pipe = redis_conn.pipeline()
+        self._queue_slice_state(pipe, index, "compressed", total_shares)
+        pipe.execute()
+
+    def _register_indexes(self, indexes):
+        """ Registers the slices that exist at the given indexes. Returns the
+        indexes that have no slice """
+        keys = ["chain_{}_slice_{}".format(self.id, index) for index in indexes]
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        key_types = pipe.execute()
+        for key, key_type in zip(keys, key_types):
+            if key_type == "hash":
+                pipe.hget(key, "total_shares")
+        totals = iter(pipe.execute())
+
+        missing = []
+        pipe = redis_conn.pipeline()
+        for index, key_type in zip(indexes, key_types):
+            if key_type == "list":
+                self._queue_slice_state(pipe, index, "raw")
+            elif key_type == "hash":
+                self._queue_slice_state(pipe, index, "compressed",
+                                        next(totals) or 0)
+            elif key_type == "none":
+                missing.append(index)
+            else:
+                raise Exception("Unexpected slice key type {}".format(key_type))
+        pipe.execute()
+        return missing
+
+    def register_slices(self, top):
+        """
+        Adds any slices above the highest registered index, up to `top`, to
+        the slice registry. If the registry is empty the search goes down
+        until 20 indexes in a row have no slice. Returns the indexes of all
+        raw slices, highest first.
+        """
+        highest = redis_conn.zrevrange(self._registry_key, 0, 0, withscores=True)
+        stop = int(highest[0][1]) if highest else -1
+
+        empty = 0
+        for batch_start in xrange(top, stop, -self.slice_batch_size):
+            indexes = range(batch_start,
+                            max(batch_start - self.slice_batch_size, stop), -1)
+            missing = set(self._register_indexes(indexes))
+            for index in indexes:
+                empty = empty + 1 if index in missing else 0
+
+            if not highest and empty >= 20:
+                break
+
+        return sorted((int(index) for index in redis_conn.smembers(self._raw_key)),
+                      reverse=True)
+
+    def sweep_slices(self):
+        """ Registers slices that register_slices missed because they were
+        written below the highest registered index. Every slice key has to
+        be scanned for, so this only runs along with cleanup. Returns the
+        indexes that were registered. """
+        prefix = "chain_{}_slice_".format(self.id)
+        indexes = set()
+        for key in scan_keys(prefix + "*"):
+            index = key[len(prefix):]
+            if index.isdigit():
+                indexes.add(int(index))
+        indexes -= set(int(score) for _, score in
+                       redis_conn.zrange(self._registry_key, 0, -1,
+                                         withscores=True))
+        indexes = sorted(indexes)
+        missing = set()
+        for i in xrange(0, len(indexes), self.slice_batch_size):
+            missing.update(self._register_indexes(
+                indexes[i:i + self.slice_batch_size]))
+        return [index for index in indexes if index not in missing]
+
+    def registered_slices(self, high, low=None):
+        """ Yields (index, state, total_shares) for each registered slice from
+        high down to low, inclusive """
+        low = '-inf' if low is None else low
+        start = 0
+        while True:
+            members = redis_conn.zrevrangebyscore(self._registry_key, high, low,
+                                                  start=start, num=1000)
+            for member in members:
+                index, state, total_shares = member.split(":")
+                yield int(index), state, float(total_shares)
+            if len(members) < 1000:
+                return
+            start += len(members)
+
+    def lowest_slice(self):
+        """ Returns the index of the oldest registered slice, or None if the
+        registry is empty """
+        lowest = redis_conn.zrange(self._registry_key, 0, 0, withscores=True)
+        if not lowest:
+            return None
+        return int(lowest[0][1])
+
+    def unregister_slices(self, high):
+        """ Removes every slice at or below `high` from the registry """
+        indexes = [index for index, _, _ in self.registered_slices(high)]
+        pipe = redis_conn.pipeline()
+        pipe.zremrangebyscore(self._registry_key, '-inf', high)
+        if indexes:
+            pipe.srem(self._raw_key, *indexes)
+        pipe.execute()
+
+    def _iter_slices(self, high, low, stats):
+        """ Yields (index, entries) for every slice from high down to, but not
+        including, low. Slices are fetched in pipelined batches. """
+        for batch_start in xrange(high, low, -self.slice_batch_size):
+            indexes = range(batch_start,
+                            max(batch_start - self.slice_batch_size, low),
+                            -1)
+            stats['index'] = indexes[-1]
+
+            # Fetch a whole window of slice information at once
+            t = time.time()
+            slices = self._fetch_slices(indexes)
+            stats['retrieval_time'] += time.time() - t
+            stats['batches'] += 1
+
+            for index, slc in slices:
+                # Decode slice information
+                t = time.time()
+                entries = self.decode_slice(slc)
+                stats['decoding_time'] += time.time() - t
+                yield index, entries
+
+    def _scan_slices(self, users, high, low, target_shares, stats):
+        """ Adds the entries of each slice from high down to low (exclusive)
+        to users until target_shares is reached. Returns True if it was. """
+        for index, entries in self._iter_slices(high, low, stats):
+            stats['index'] = index
+            t = time.time()
+            for user, shares in entries:
+                assert isinstance(shares, (dec, int))
+                if user not in users:
+                    users[user] = shares
+                else:
+                    users[user] += shares
+                stats['entries'] += 1
+                stats['shares'] += shares
+                if target_shares and stats['shares'] >= target_shares:
+                    stats['aggregation_time'] += time.time() - t
+                    return True
+            stats['aggregation_time'] += time.time() - t
+        return False
+
+    def _sum_slices(self, users, high, low, stats, sign=1):
+        """ Adds (or subtracts with a negative sign) every entry from slice
+        high down to low (exclusive) to users """
+        for index, entries in self._iter_slices(high, low, stats):
+            t = time.time()
+            for user, shares in entries:
+                users[user] = users.get(user, 0) + shares * sign
+            stats['aggregation_time'] += time.time() - t
+
+    # Running share accumulator
+    # =========================================================================
+    # Every chain keeps a running tally of shares for compressed slices in
+    # redis so that payouts don't have to decode every slice in their window.
+    #   chain_{id}_acc_floor: Oldest index the accumulator can answer from
+    #   chain_{id}_acc_head: Newest slice index folded into the accumulator
+    #   chain_{id}_acc_cumulative: Hash of slice index -> total shares in
+    #       all slices from the floor up to and including that index
+    #   chain_{id}_acc_prefix_{index}: Hash of user -> shares from the floor
+    #       up to and including the index. Kept for the floor and every
+    #       `accumulator_interval` indexes after that, along with a ":total"
+    #       field so a checkpoint is never an empty (nonexistent) key
+    #   chain_{id}_acc_prefix_head: The same as above, but for the head
+    accumulator_interval = 25
+
+    def _acc_key(self, name):
+        return "chain_{}_acc_{}".format(self.id, name)
+
+    def _checkpoint_for(self, index, floor):
+        """ The newest checkpoint index at or below index """
+        return max(floor, index - (index % self.accumulator_interval))
+
+    def _load_checkpoints(self, *indexes):
+        """ Fetches prefix checkpoints. Returns None if any are missing """
+        pipe = redis_conn.pipeline(transaction=False)
+        for index in indexes:
+            pipe.hgetall(self._acc_key("prefix_{}".format(index)))
+
+        checkpoints = []
+        for raw in pipe.execute():
+            if not raw:
+                return None
+            checkpoints.append({user: dec(shares) for user, shares
+                                in raw.iteritems() if user != ":total"})
+        return checkpoints
+
+    def _accumulator_bounds(self):
+        floor, head = redis_conn.mget([self._acc_key("floor"),
+                                       self._acc_key("head")])
+        if floor is None or head is None:
+            return None
+        return int(floor), int(head)
+
+    def _accumulated_shares(self, users, start_slice, stop_slice,
+                            target_shares, stats, floor, head):
+        """ Computes the same result as _scan_slices, but only decodes the
+        slices outside the accumulators range and at most a few slices around
+        each end of the range inside it. Returns False if the accumulator was
+        found to be incomplete, leaving users in an undefined state. """
+        # Slices newer than the accumulator have to be read directly
+        if start_slice > head:
+            if self._scan_slices(users, start_slice, max(head, stop_slice),
+                                 target_shares, stats):
+                return True
+
+        high = min(start_slice, head)
+        low = max(stop_slice, floor)
+        if high > low:
+            indexes = range(low, high + 1)
+            t = time.time()
+            raw = redis_conn.hmget(self._acc_key("cumulative"), indexes)
+            stats['retrieval_time'] += time.time() - t
+            if None in raw:
+                return False
+            cumulative = dict(zip(indexes, [dec(v) for v in raw]))
+
+            # Find the slice in which target_shares gets reached (if it does)
+            boundary = None
+            if target_shares:
+                for index in xrange(high, low, -1):
+                    if (stats['shares'] + cumulative[high] -
+                            cumulative[index - 1] >= target_shares):
+                        boundary = index
+                        break
+
+            # Take all the complete slices from the accumulator
+            oldest = low if boundary is None else boundary
+            if oldest < high:
+                c_high = self._checkpoint_for(high, floor)
+                c_low = self._checkpoint_for(oldest, floor)
+                range_users = {}
+                if c_high == c_low:
+                    self._sum_slices(range_users, high, oldest, stats)
+                else:
+                    t = time.time()
+                    checkpoints = self._load_checkpoints(c_high, c_low)
+                    stats['retrieval_time'] += time.time() - t
+                    if checkpoints is None:
+                        return False
+                    prefix_high, prefix_low = checkpoints
+                    for user, shares in prefix_high.iteritems():
+                        range_users[user] = shares - prefix_low.pop(user, 0)
+                    for user, shares in prefix_low.iteritems():
+                        range_users[user] = -shares
+                    self._sum_slices(range_users, high, c_high, stats)
+                    self._sum_slices(range_users, oldest, c_low, stats, -1)
+
+                for user, shares in range_users.iteritems():
+                    if not shares:
+                        continue
+                    if user not in users:
+                        users[user] = shares
+                    else:
+                        users[user] += shares
+                stats['shares'] += cumulative[high] - cumulative[oldest]
+                stats['index'] = oldest + 1
+
+            # The boundary slice has to be walked in order to stop at exactly
+            # the same entry a full scan would have
+            if boundary is not None:
+                return self._scan_slices(users, boundary, boundary - 1,
+                                         target_shares, stats)
+
+        # Slices older than the accumulator have to be read directly
+        if floor > stop_slice:
+            self._scan_slices(users, min(floor, start_slice), stop_slice,
+                              target_shares, stats)
+        return True
+
+    def update_accumulator(self, decoded=None):
+        """ Folds all compressed slices newer than the accumulator head into
+        the accumulator, stopping at the first uncompressed slice and
+        leaving out missing slices past the newest compressed one. `decoded`
+        can map slice indexes to already decoded entries to avoid decoding
+        them again. Returns the number of slices that were folded in. """
+        decoded = decoded or {}
+        last_index = redis_conn.get("chain_{}_slice_index".format(self.id))
+        if last_index is None:
+            return 0
+        last_index = int(last_index)
+
+        bounds = self._accumulator_bounds()
+        if bounds is None:
+            # Start a new accumulator from the oldest slice that _calc_shares
+            # would ever look at
+            self.reset_accumulator()
+            floor = head = max(self.min_index, last_index - self.max_indexes)
+            running = {}
+            total = 0
+            new = True
+        else:
+            floor, head = bounds
+            raw = redis_conn.hgetall(self._acc_key("prefix_head"))
+            if not raw:
+                current_app.logger.warn(
+                    "Accumulator for chain {} has no head prefix, resetting"
+                    .format(self.id))
+                self.reset_accumulator()
+                return 0
+            total = dec(raw.pop(":total"))
+            running = {user: dec(shares) for user, shares in raw.iteritems()}
+            new = False
+
+        cumulative = {}
+        checkpoints = {}
+
+        def fold(index, entries, total):
+            for user, shares in entries:
+                running[user] = running.get(user, 0) + shares
+                total += shares
+            cumulative[index] = total
+            if index % self.accumulator_interval == 0:
+                checkpoints[index] = running.copy()
+            return total
+
+        pipe = redis_conn.pipeline(transaction=False)
+        stop = False
+        missing = []
+        for batch_start in xrange(head + 1, last_index + 1, self.slice_batch_size):
+            indexes = range(batch_start,
+                            min(batch_start + self.slice_batch_size,
+                                last_index + 1))
+            keys = ["chain_{}_slice_{}".format(self.id, index)
+                    for index in indexes]
+            for key in keys:
+                pipe.type(key)
+            key_types = pipe.execute()
+
+            # Only fetch the compressed slices we don't already have
+            for index, key, key_type in zip(indexes, keys, key_types):
+                if key_type == "hash" and index not in decoded:
+                    pipe.hgetall(key)
+            results = iter(pipe.execute())
+
+            for index, key_type in zip(indexes, key_types):
+                if key_type == "list":
+                    # Can't fold in past slices that haven't been compressed
+                    stop = True
+                    break
+                elif key_type == "none":
+                    # Missing slices are only known to be empty once a newer
+                    # slice has been compressed, until then shares could
+                    # still be written to them
+                    missing.append(index)
+                    continue
+                elif key_type != "hash":
+                    raise Exception("Unexpected slice key type {}"
+                                    .format(key_type))
+
+                if index in decoded:
+                    entries = decoded[index]
+                else:
+                    entries = self.decode_slice(next(results))
+                for empty in missing:
+                    fold(empty, [], total)
+                missing = []
+                total = fold(index, entries, total)
+                head = index
+
+            if stop:
+                break
+
+        folded = len(cumulative)
+        if not folded and not new:
+            return 0
+
+        pipe = redis_conn.pipeline()
+        if new:
+            cumulative[floor] = 0
+            pipe.hmset(self._acc_key("prefix_{}".format(floor)),
+                       {":total": 0})
+            pipe.set(self._acc_key("floor"), floor)
+        if cumulative:
+            pipe.hmset(self._acc_key("cumulative"), cumulative)
+        for index, prefix in checkpoints.iteritems():
+            prefix[":total"] = cumulative[index]
+            pipe.hmset(self._acc_key("prefix_{}".format(index)), prefix)
+        running[":total"] = total
+        pipe.delete(self._acc_key("prefix_head"))
+        pipe.hmset(self._acc_key("prefix_head"), running)
+        pipe.set(self._acc_key("head"), head)
+        pipe.execute()
+
+        current_app.logger.info(
+            "Folded {:,} slices into the accumulator for chain {}, head is "
+            "now #{:,}".format(folded, self.id, head))
+
+        # Drop checkpoints for slices that _calc_shares won't look at anymore
+        self.trim_accumulator(max(self.min_index, last_index - self.max_indexes))
+        return folded
+
+    def trim_accumulator(self, new_floor):
+        """ Moves the accumulator floor up to new_floor so that slices at or
+        below it can be deleted. """
+        bounds = self._accumulator_bounds()
+        if bounds is None:
+            return
+        floor, head = bounds
+        if new_floor <= floor:
+            return
+        if new_floor >= head:
+            # Nothing in the accumulator is worth keeping
+            self.reset_accumulator()
+            return
+
+        # Build the prefix for the new floor before its slices go away
+        checkpoint = self._checkpoint_for(new_floor, floor)
+        prefixes = self._load_checkpoints(checkpoint)
+        if prefixes is None:
+            current_app.logger.warn(
+                "Accumulator for chain {} is missing checkpoint {}, resetting"
+                .format(self.id, checkpoint))
+            self.reset_accumulator()
+            return
+        prefix = prefixes[0]
+        stats = dict(retrieval_time=0.0, decoding_time=0.0,
+                     aggregation_time=0.0, batches=0, index=0)
+        self._sum_slices(prefix, new_floor, checkpoint, stats)
+        prefix = {user: shares for user, shares in prefix.iteritems() if shares}
+        prefix[":total"] = redis_conn.hget(self._acc_key("cumulative"),
+                                           new_floor)
+        if prefix[":total"] is None:
+            self.reset_accumulator()
+            return
+
+        stale = [floor] + range(floor - (floor % self.accumulator_interval) +
+                                self.accumulator_interval,
+                                new_floor, self.accumulator_interval)
+        pipe = redis_conn.pipeline()
+        pipe.hmset(self._acc_key("prefix_{}".format(new_floor)), prefix)
+        pipe.set(self._acc_key("floor"), new_floor)
+        pipe.delete(*[self._acc_key("prefix_{}".format(index))
+                      for index in stale if index != new_floor])
+        pipe.hdel(self._acc_key("cumulative"), *range(floor, new_floor))
+        pipe.execute()
+
+    def reset_accumulator(self):
+        """ Removes all of the accumulator data for this chain """
+        bounds = self._accumulator_bounds()
+        keys = [self._acc_key(name) for name in
+                ("floor", "head", "cumulative", "prefix_head")]
+        if bounds is not None:
+            floor, head = bounds
+            keys.extend(self._acc_key("prefix_{}".format(index))
+                        for index in [floor] + range(
+                            floor - (floor % self.accumulator_interval),
+                            head + 1, self.accumulator_interval))
+        redis_conn.delete(*keys)
+
     def _calc_shares(self, start_slice, target_shares=None, stop_slice=None):
         if target_shares is not None and target_shares <= 0:
             raise ValueError("Taget shares ({}) must be positive"
@@ -419,69 +1054,38 @@ class Chain(ConfigObject):
             raise Exception("stop_slice {} cannot be greater than start_slice {}!"
                             .format(stop_slice, start_slice))
 
-        found_shares = 0
-        entry_count = 0
-        users = {}
-        index = 0
-        decoding_time = 0.0
-        retrieval_time = 0.0
-        aggregation_time = 0.0
-        for index in xrange(start_slice, stop_slice, -1):
-            slc_key = "chain_{}_slice_{}".format(self.id, index)
-            key_type = redis_conn.type(slc_key)
-
-            # Fetch slice information
-            t = time.time()
-            if key_type == "list":
-                slc = dict(encoding="colon_list", data=redis_conn.lrange(slc_key, 0, -1))
-            elif key_type == "hash":
-                slc = redis_conn.hgetall(slc_key)
-            elif key_type == "none":
-                continue
-            else:
-                raise Exception("Unexpected slice key type {}".format(key_type))
-            retrieval_time += time.time() - t
-
-            # Decode slice information
-            t = time.time()
-            if slc['encoding'] == "bz2json":
-                serialized = bz2.decompress(slc['data'])
-                entries = json.loads(serialized, use_decimal=True)
-            elif slc['encoding'] == "colon_list":
-                # Parse the list into proper python representation
-                entries = []
-                for entry in slc['data']:
-                    user, shares = entry.split(":")
-                    shares = dec(shares)
-                    entries.append((user, shares))
-            else:
-                raise Exception("Unsupported slice data encoding {}"
-                                .format(slc['encoding']))
-            decoding_time += time.time() - t
-
-            t = time.time()
-            for user, shares in entries:
-                assert isinstance(shares, (dec, int))
-                if user not in users:
-                    users[user] = shares
-                else:
-                    users[user] += shares
-                entry_count += 1
-                found_shares += shares
-                if target_shares and found_shares >= target_shares:
-                    break
-            aggregation_time += time.time() - t
+        def new_stats():
+            return dict(shares=0, entries=0, batches=0, index=0,
+                        retrieval_time=0.0, decoding_time=0.0,
+                        aggregation_time=0.0)
 
-            if target_shares and found_shares >= target_shares:
-                break
+        users = {}
+        stats = new_stats()
+        method = "scan"
+        bounds = self._accumulator_bounds()
+        if bounds is not None:
+            method = "accumulator"
+            if not self._accumulated_shares(users, start_slice, stop_slice,
+                                            target_shares, stats, *bounds):
+                current_app.logger.warn(
+                    "Accumulator for chain {} is incomplete, falling back to "
+                    "scanning slices".format(self.id))
+                users = {}
+                stats = new_stats()
+                method = "scan"
+        if method == "scan":
+            self._scan_slices(users, start_slice, stop_slice, target_shares,
+                              stats)
 
         current_app.logger.info(
             "Aggregated {:,} shares from {:,} entries for {:,} different users "
-            "from slice #{:,} -> #{:,}. retrieval_time: {}; decoding_time: {}"
-            " aggregation_time: {}"
-            .format(found_shares, entry_count, len(users), start_slice, index,
-                    time_format(retrieval_time), time_format(decoding_time),
-                    time_format(aggregation_time)))
+            "from slice #{:,} -> #{:,} in {:,} batches using {}. retrieval_time:"
+            " {}; decoding_time: {} aggregation_time: {}"
+            .format(stats['shares'], stats['entries'], len(users), start_slice,
+                    stats['index'], stats['batches'], method,
+                    time_format(stats['retrieval_time']),
+                    time_format(stats['decoding_time']),
+                    time_format(stats['aggregation_time'])))
 
         return users
 
@@ -494,15 +1098,16 @@ class PPLNSChain(Chain):
         Chain.__init__(self, bootstrap)
         self.last_n = float(self.last_n)
 
-    def calc_shares(self, block_payout):
+    def share_window(self, block_payout):
         assert block_payout.chainid == self.id
         n = (block_payout.block.difficulty * (2 ** 32)) / self.algo.hashes_per_share
         target_shares = n * self.last_n
-        return self._calc_shares(block_payout.solve_slice, target_shares=target_shares)
+        return dict(start_slice=block_payout.solve_slice,
+                    target_shares=target_shares)
 
 
 class PropChain(Chain):
-    def calc_shares(self, block_payout):
+    def share_window(self, block_payout):
         assert block_payout.chainid == self.id
         curr_block = block_payout.block
         last_block = (m.Block.query.filter_by(algo=curr_block.algo,
@@ -516,7 +1121,7 @@ class PropChain(Chain):
             if len(bps) > 0:
                 last_block_payout = bps[0]
                 stop_slice = last_block_payout.solve_slice
-        return self._calc_shares(block_payout.solve_slice, stop_slice=stop_slice)
+        return dict(start_slice=block_payout.solve_slice, stop_slice=stop_slice)
 
 
 class ChainKeeper(Keeper):
@@ -552,6 +1157,8 @@ class AlgoKeeper(Keeper):
 
 class PowerPool(ConfigObject):
     timeout = 10
+    failure_limit = 3
+    retry_after = 60
     requires = ['_chain', 'port', 'address', 'monitor_address', '_location']
 
     def __init__(self, bootstrap):
@@ -560,6 +1167,15 @@ class PowerPool(ConfigObject):
         bootstrap['key'] = int(bootstrap['key'])
         ConfigObject.__init__(self, bootstrap)
         self.id = self.key
+        # Keep-alive connections to the monitor, made on first use
+        self._session = None
+        # Circuit breaker state. Consecutive failed requests, when to let a
+        # probe request through once failure_limit is reached, and whether
+        # one is running. Requests come from many threads at once
+        self._failures = 0
+        self._retry_at = 0
+        self._probing = False
+        self._breaker_lock = threading.Lock()
 
     @property
     def stratum_address(self):
@@ -572,13 +1188,65 @@ class PowerPool(ConfigObject):
     def __hash__(self):
         return self.key
 
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.mount("http://", requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=4))
+        return self._session
+
     def request(self, url, method='GET', max_age=None, signed=True, **kwargs):
         url = "{}/{}".format(self.monitor_address.rstrip('/'), url.lstrip('/'))
-        ret = requests.request(method, url, timeout=self.timeout, **kwargs)
+        probe = False
+        with self._breaker_lock:
+            if self._failures >= self.failure_limit:
+                if self._probing or time.time() < self._retry_at:
+                    raise RemoteException("Skipping endpoint {} after {} failures"
+                                          .format(url, self._failures))
+                # Let a single request through to see if the monitor is back
+                probe = self._probing = True
+
+        try:
+            ret = self._request(method, url, **kwargs)
+        except Exception:
+            with self._breaker_lock:
+                self._failures += 1
+                self._retry_at = time.time() + self.retry_after
+                if probe:
+                    self._probing = False
+            raise
+        with self._breaker_lock:
+            self._failures = 0
+            if probe:
+                self._probing = False
+        return ret
+
+    def _request(self, method, url, handler=None, **kwargs):
+        """ Makes the request, decoding the JSON response. If a handler is
+        given the response is streamed and the handler is called with it
+        instead, returning whatever it does. """
+        try:
+            ret = self.session.request(method, url, timeout=self.timeout,
+                                       stream=handler is not None, **kwargs)
+        except requests.RequestException as e:
+            raise RemoteException("Unable to reach endpoint {}: {}"
+                                  .format(url, e))
         if ret.status_code != 200:
             raise RemoteException("Non 200 from endpoint {}: {}"
                                   .format(url, ret.text.encode('utf8')[:100]))
 
+        if handler is not None:
+            # A streamed response only goes back to the session's connection
+            # pool once it's closed, however the handler gets on
+            try:
+                return handler(ret)
+            except Exception as e:
+                raise RemoteException("Bad response from endpoint {}: {}: {}"
+                                      .format(url, type(e).__name__, e))
+            finally:
+                ret.close()
+
         current_app.logger.debug("Got {} from remote"
                                  .format(ret.text.encode('utf8')))
         try:
@@ -603,3 +1271,45 @@ class PowerPool(ConfigObject):
 
 class PowerPoolKeeper(Keeper):
     type_map = dict(default=PowerPool)
+
+    def request_all(self, url, **kwargs):
+        """ Makes the same request to every powerpool's monitor at once.
+        Returns a dictionary of {powerpool: (result, error)}, where error is
+        the exception raised if the request failed. """
+        return {powerpool: results[0] for powerpool, results
+                in self.request_each([url], **kwargs).iteritems()}
+
+    def request_each(self, urls, **kwargs):
+        """ Like request_all, but requests each of a list of urls from every
+        monitor, all at once. A url may also be a (url, kwargs) pair to pass
+        extra arguments for just that url. Returns a dictionary of
+        {powerpool: [(result, error), ...]} with a pair for each url in
+        order. """
+        jobs = [(powerpool, url) for powerpool in self.values() for url in urls]
+        if not jobs:
+            return {}
+        app = current_app._get_current_object()
+
+        def request(job):
+            powerpool, url = job
+            extra = kwargs
+            if isinstance(url, tuple):
+                url, extra = url
+                extra = dict(kwargs, **extra)
+            with app.app_context():
+                try:
+                    return powerpool.request(url, **extra), None
+                except Exception as e:
+                    return None, e
+
+        pool = ThreadPool(len(jobs))
+        try:
+            results = pool.map(request, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        ret = {}
+        for (powerpool, url), result in zip(jobs, results):
+            ret.setdefault(powerpool, []).append(result)
+        return ret
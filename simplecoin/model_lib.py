@@ -41,6 +41,20 @@ class SqliteNumeric(types.TypeDecorator):
 db.Numeric = SqliteNumeric
 
 
+def bulk_insert(table, rows, chunk_size=1000):
+    """ Inserts a list of dictionaries of column values into a table within
+    the current session's transaction. PostgreSQL gets multi-row INSERT
+    statements, other databases fall back to executemany. Every row must have
+    the same keys. """
+    if not rows:
+        return
+    if db.engine.dialect.name != "postgresql":
+        db.session.execute(table.insert(), rows)
+        return
+    for i in xrange(0, len(rows), chunk_size):
+        db.session.execute(table.insert().values(rows[i:i + chunk_size]))
+
+
 class BaseMapper(object):
     # Allows us to run query on the class directly, instead of through a
     # session
@@ -3,13 +3,14 @@ from decimal import Decimal
 import decimal
 import logging
 import cPickle
+import itertools
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from datetime import datetime, timedelta
 from flask import current_app
-from sqlalchemy.schema import CheckConstraint
+from sqlalchemy.schema import CheckConstraint, CreateIndex
 
-from .model_lib import base
+from .model_lib import base, bulk_insert
 from .filters import sig_round
 from . import db, currencies, chains, algos, cache
 
@@ -164,41 +165,34 @@ class ChainPayout(base):
         return self.hashes / 1000000
 
     def make_credit_obj(self, user, address, currency, shares):
-        """ Makes the appropriate credit object given a few details. Payout
-        amount too be calculated. """
-        # If they're trying to get paid to invalid currency pay it to the
-        # pool
-
+        """ Records the appropriate credit row given a few details. Payout
+        amount too be calculated, and the rows get written with
+        Credit.bulk_create. """
         key = (user, address, currency)
 
-        # If there's already a payout object with this information
+        # If there's already a credit row with this information
         if key in self.credits:
-            self.credits[key].shares += shares
+            self.credits[key]['shares'] += shares
             return
 
-        p = Credit.make_credit(
-            user=user,
-            block=self.block,
-            sharechain_id=self.chainid,
-            currency=currency.key,
-            source=0,
-            address=address)
-        p.shares = shares
-
-        db.session.add(p)
-        self.credits[key] = p
+        self.credits[key] = dict(user=user,
+                                 sharechain_id=self.chainid,
+                                 currency=currency.key,
+                                 source=0,
+                                 address=address,
+                                 shares=shares)
 
     def distribute(self):
         share_distrib = {}
         total_shares = 0
         for key, credit in self.credits.iteritems():
-            share_distrib[key] = credit.shares
-            total_shares += credit.shares
+            share_distrib[key] = credit['shares']
+            total_shares += credit['shares']
 
         assert total_shares == self.payout_shares, "Chain had payout share count mismatch at distribution time!"
         credit_distrib = distributor(self.amount, share_distrib)
         for key in share_distrib:
-            self.credits[key].amount = credit_distrib[key]
+            self.credits[key]['amount'] = credit_distrib[key]
 
 
 class Block(base):
@@ -231,6 +225,10 @@ class Block(base):
     # The hashing algorith mused to solve the block
     algo = db.Column(db.String, nullable=False)
 
+    __table_args__ = (
+        db.Index('found_at_idx', 'found_at'),
+    )
+
     standard_join = ['status', 'merged', 'currency', 'worker', 'explorer_link',
                      'luck', 'total_value', 'difficulty', 'duration',
                      'found_at', 'time_started']
@@ -427,6 +425,7 @@ class Credit(base):
     __table_args__ = (
         db.Index('payable_idx', 'payable'),
         db.Index('user_idx', 'user'),
+        db.Index('payout_idx', 'payout_id'),
     )
 
     __mapper_args__ = {
@@ -452,6 +451,54 @@ class Credit(base):
                 **kwargs)
         return p
 
+    @classmethod
+    def bulk_create(cls, block, rows):
+        """ Inserts credits for a flushed block from a list of dictionaries,
+        without building an ORM object for each. Like make_credit, credits
+        in a currency other than the block's become CreditExchanges. """
+        credits = []
+        exchanges = []
+        for row in rows:
+            values = dict(block_id=block.id,
+                          user=row['user'],
+                          sharechain_id=row.get('sharechain_id'),
+                          address=row['address'],
+                          currency=row['currency'],
+                          amount=row['amount'],
+                          fee_perc=row.get('fee_perc', 0),
+                          pd_perc=row.get('pd_perc', 0),
+                          payable=False,
+                          source=row['source'],
+                          payout_id=None)
+            if row['currency'] != block.currency:
+                values['type'] = CreditExchange.__mapper__.polymorphic_identity
+                exchanges.append(values)
+            else:
+                values['type'] = Credit.__mapper__.polymorphic_identity
+                credits.append(values)
+
+        bulk_insert(Credit.__table__, credits)
+        if not exchanges:
+            return
+
+        # The credit_exchange rows need the ids of their credit rows
+        if db.engine.dialect.name == "postgresql":
+            ids = db.session.execute(
+                "SELECT nextval(pg_get_serial_sequence('credit', 'id')) "
+                "FROM generate_series(1, :count)",
+                dict(count=len(exchanges))).fetchall()
+            for values, (credit_id, ) in zip(exchanges, ids):
+                values['id'] = credit_id
+            bulk_insert(Credit.__table__, exchanges)
+        else:
+            for values in exchanges:
+                values['id'] = db.session.execute(
+                    Credit.__table__.insert(), values).inserted_primary_key[0]
+        bulk_insert(CreditExchange.__table__,
+                    [dict(id=values['id'], sell_req_id=None, sell_amount=None,
+                          buy_req_id=None, buy_amount=None)
+                     for values in exchanges])
+
     @property
     def payable_amount(self):
         return self.amount
@@ -629,6 +676,8 @@ def sum_combine(cls, *lst):
 class TimeSlice(object):
     """ An time abstracted data sample that pertains to a single worker.
     Currently used to represent accepted and rejected shares. """
+    # Whether the table can be converted to partitioned storage
+    partitionable = False
 
     @property
     def end_time(self):
@@ -647,6 +696,58 @@ class TimeSlice(object):
         db.session.add(slc)
         return slc
 
+    @classmethod
+    def bulk_upsert(cls, rows, chunk_size=1000):
+        """ Adds a list of slices, given as dictionaries of column values, in
+        as few statements as possible. Rows with the same key are combined in
+        memory first, then combined with any that are already in the
+        database. PostgreSQL does this with INSERT ... ON CONFLICT, other
+        databases by updating the existing rows and inserting the rest.
+        Returns the number of rows written. """
+        pk = cls._conflict_keys()
+        groups = {}
+        for row in rows:
+            key = tuple(row[name] for name in pk)
+            groups.setdefault(key, (row, []))[1].append(row['value'])
+        merged = {key: dict(row, value=cls.combine(*values))
+                  for key, (row, values) in groups.iteritems()}
+        if not merged:
+            return 0
+
+        table = cls.__table__
+        if db.engine.dialect.name == "postgresql":
+            quote = db.engine.dialect.identifier_preparer.quote
+            conflict = " ON CONFLICT ({}) DO UPDATE SET value = {}".format(
+                ", ".join(quote(name) for name in pk),
+                cls.combine_sql.format(old=quote(table.name) + ".value",
+                                       new="EXCLUDED.value"))
+            rows = merged.values()
+            for i in xrange(0, len(rows), chunk_size):
+                compiled = table.insert().values(rows[i:i + chunk_size]).compile(
+                    dialect=db.engine.dialect)
+                db.session.connection().execute(str(compiled) + conflict,
+                                                compiled.params)
+            return len(rows)
+
+        written = len(merged)
+        # Lock the existing rows 100 keys at a time, so every key column can
+        # be narrowed with an IN list that stays small. Sorting keeps each
+        # chunk's lists short
+        keys = sorted(merged)
+        for i in xrange(0, len(keys), 100):
+            chunk = keys[i:i + 100]
+            query = db.session.query(cls)
+            for j, name in enumerate(pk):
+                query = query.filter(
+                    getattr(cls, name).in_(set(key[j] for key in chunk)))
+            for slc in query.with_lockmode('update'):
+                key = tuple(getattr(slc, name) for name in pk)
+                if key in merged:
+                    slc.value = cls.combine(slc.value, merged.pop(key)['value'])
+        db.session.flush()
+        bulk_insert(table, merged.values())
+        return written
+
     @classmethod
     def add_value(cls, user, value, time, worker):
         dt = cls.floor_time(time)
@@ -665,75 +766,31 @@ class TimeSlice(object):
         return datetime.utcfromtimestamp(time)
 
     @classmethod
-    def compress(cls, span, delete=True):
+    def compress(cls, span):
+        """ Rolls slices of the given span that have aged out of their window
+        up into slices of the next span, one window at a time. Each window is
+        grouped and combined by the database, merged into any upper slices
+        that already exist, and the source slices removed with one ranged
+        delete. """
         # If we're trying to compress the largest slice boundary
         if span == len(cls.span_config) - 1:
             raise Exception("Can't compress this!")
         upper_span = span + 1
 
-        # the timestamp of the slice currently being processed
-        current_slice = None
-        # dictionary of lists keyed by item_hash
-        items = {}
-
-        def create_upper():
-            # add a time slice for each user in this pending period
-            for key, slices in items.iteritems():
-                # Allows us to use different combining methods. Ie averaging or
-                # adding
-                new_val = cls.combine(*[slc.value for slc in slices])
-
-                # put it in the database
-                upper = cls.query.filter_by(time=current_slice, span=upper_span, **key._asdict()).with_lockmode('update').first()
-                # wasn't in the db? create it
-                if not upper:
-                    upper = cls(time=current_slice, value=new_val, span=upper_span, **key._asdict())
-                    db.session.add(upper)
-                else:
-                    upper.value = cls.combine(upper.value, new_val)
-
-                if delete:
-                    for slc in slices:
-                        db.session.delete(slc)
-
-            items.clear()
-            db.session.commit()
-            db.session.expire_all()
-
         # get the minute shares that are old enough to be compressed and
         # deleted
         upper_time = cls.floor_time(datetime.utcnow(), upper_span) - cls.span_config[span]['window']
         lower_time = upper_time - cls.span_config[span]['window']
 
+        if cls.partitioned():
+            cls._compress_partitions(span, upper_time)
+            return
+
         # while there are some old slices to combine
-        while cls.query.filter(cls.time <= upper_time).filter_by(span=span).count() > 0:
-
-            # traverse slices that are old enough to combine in time order
-            found_slices = 0
-            chunk_slices = 0
-            for slc in cls.query.filter(cls.time < upper_time).filter(cls.time >= lower_time).filter_by(span=span).order_by(cls.time):
-                slice_time = cls.floor_time(slc.time, upper_span)
-
-                if current_slice is None:
-                    current_slice = slice_time
-
-                # we've encountered the next time slice, so commit the pending one
-                if slice_time != current_slice:
-                    logging.info("Processing slice {} with {:,} members"
-                                 .format(current_slice, chunk_slices))
-                    chunk_slices = 0
-                    create_upper()
-                    current_slice = slice_time
-
-                # add the one min shares for this user the list of pending shares
-                # to be grouped together
-                key = slc.item_key
-                items.setdefault(key, [])
-                items[key].append(slc)
-                found_slices += 1
-                chunk_slices += 1
-
-            create_upper()
+        while (cls.query.filter(cls.time < upper_time).filter_by(span=span).
+               first() is not None):
+            found_slices = cls._compress_window(span, lower_time, upper_time)
+            db.session.commit()
 
             # Move the time span window backwards
             logging.info("Found {:,} slices to combine from {} to {}!"
@@ -741,16 +798,217 @@ class TimeSlice(object):
             upper_time -= cls.span_config[span]['window']
             lower_time -= cls.span_config[span]['window']
 
+    @classmethod
+    def _compress_window(cls, span, lower_time, upper_time):
+        """ Compresses all the slices of `span` in [lower_time, upper_time)
+        into the next span. Returns how many slices were compressed. """
+        upper_span = span + 1
+        seconds = int(cls.span_config[upper_span]['slice'].total_seconds())
+        table = cls.__table__
+        params = dict(span=span, upper_span=upper_span, lower=lower_time,
+                      upper=upper_time, seconds=seconds)
+
+        if db.engine.dialect.name == "postgresql":
+            name = db.engine.dialect.identifier_preparer.quote(table.name)
+            cls._rollup(name, span, "span = :span AND time >= :lower AND "
+                        "time < :upper", params)
+            return db.session.execute(
+                "DELETE FROM {} WHERE span = :span AND time >= :lower AND "
+                "time < :upper".format(name), params).rowcount
+
+        # SQLite has no INSERT ... ON CONFLICT (before 3.24), so group the
+        # window, drop the source slices and then upsert the results
+        bucket = cls._bucket(seconds)
+        columns = [getattr(cls, key) for key in cls.keys]
+        agg = getattr(db.func, cls.combine_agg)
+        window = (db.session.query(cls).filter_by(span=span).
+                  filter(cls.time >= lower_time).filter(cls.time < upper_time))
+        rows = []
+        for row in window.with_entities(bucket, agg(cls.value), *columns).\
+                group_by(bucket, *columns):
+            values = dict(zip(cls.keys, row[2:]))
+            values.update(time=datetime.utcfromtimestamp(row[0]),
+                          span=upper_span, value=row[1])
+            rows.append(values)
+        found_slices = window.delete(synchronize_session=False)
+        cls.bulk_upsert(rows)
+        return found_slices
+
+    @classmethod
+    def _bucket(cls, seconds):
+        """ An SQL expression for the timestamp of the start of the `seconds`
+        long period each slice falls in """
+        if db.engine.dialect.name == "postgresql":
+            epoch = db.func.floor(db.extract('epoch', cls.time) / seconds)
+            return db.cast(epoch, db.BigInteger) * seconds
+        return (db.cast(db.func.strftime('%s', cls.time), db.BigInteger) /
+                seconds * seconds)
+
+    @classmethod
+    def _rollup(cls, source, span, where, params):
+        """ Groups the slices of `span` in the `source` table that match
+        `where` into slices of the next span, combining them with any upper
+        slices that already exist. PostgreSQL only. """
+        quote = db.engine.dialect.identifier_preparer.quote
+        keys = ", ".join(quote(key) for key in cls.keys)
+        name = quote(cls.__table__.name)
+        params = dict(params, span=span, upper_span=span + 1, seconds=int(
+            cls.span_config[span + 1]['slice'].total_seconds()))
+        # Unless partitioned, upper slices share a primary key with the
+        # source slice at the start of their period since span isn't part of
+        # it. Those get replaced, while existing upper slices get combined
+        db.session.execute(
+            "INSERT INTO {name} (time, {keys}, span, value) "
+            "SELECT to_timestamp(floor(extract(epoch FROM time) / :seconds) "
+            "* :seconds) AT TIME ZONE 'UTC' AS bucket, {keys}, :upper_span, "
+            "{agg}(value) FROM {source} WHERE {where} "
+            "GROUP BY bucket, {keys} "
+            "ON CONFLICT ({conflict}) DO UPDATE SET "
+            "value = CASE WHEN {name}.span = :span THEN EXCLUDED.value "
+            "ELSE {combine} END, span = EXCLUDED.span"
+            .format(name=name, keys=keys, agg=cls.combine_agg, source=source,
+                    where=where,
+                    conflict=", ".join(quote(key) for key in cls._conflict_keys()),
+                    combine=cls.combine_sql.format(
+                        old=name + ".value", new="EXCLUDED.value")),
+            params)
+
+    # Partitioned storage
+    # ========================================================================
+    @classmethod
+    def partitioned(cls):
+        """ Whether slices are stored in tables partitioned by span and time,
+        which requires PostgreSQL 11 or later """
+        return bool(cls.partitionable and
+                    current_app.config['slice_partitioning'] and
+                    db.engine.dialect.name == "postgresql")
+
+    @classmethod
+    def _conflict_keys(cls):
+        """ The columns that uniquely identify a slice in the database.
+        Partitioned tables have to include span in their primary key. """
+        keys = [col.name for col in cls.__table__.primary_key]
+        if cls.partitioned():
+            keys.append("span")
+        return keys
+
+    @classmethod
+    def _partition_bounds(cls, span, time):
+        """ Returns the start and end of the partition of `span` that `time`
+        falls in. Partitions hold either a day or a month. """
+        start = datetime(time.year, time.month, time.day)
+        if cls.span_config[span]['partition'] == "day":
+            return start, start + timedelta(days=1)
+        start = start.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+
+    @classmethod
+    def _partition_format(cls, span):
+        if cls.span_config[span]['partition'] == "day":
+            return "%Y%m%d"
+        return "%Y%m"
+
+    @classmethod
+    def _partitions(cls, span):
+        """ Returns a list of (name, start, end) tuples for the existing
+        partitions of `span`, oldest first """
+        parent = "{}_s{}".format(cls.__table__.name, span)
+        names = db.session.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :parent",
+            dict(parent=parent)).fetchall()
+        partitions = []
+        for (name, ) in names:
+            start = datetime.strptime(name.rsplit("_", 1)[1],
+                                      cls._partition_format(span))
+            partitions.append((name, ) + cls._partition_bounds(span, start))
+        return sorted(partitions, key=lambda p: p[1])
+
+    @classmethod
+    def create_partitions(cls, start, end):
+        """ Makes sure partitions exist for every span from `start` through
+        `end` """
+        quote = db.engine.dialect.identifier_preparer.quote
+        for span in xrange(len(cls.span_config)):
+            parent = "{}_s{}".format(cls.__table__.name, span)
+            time = start
+            while time <= end:
+                lower, upper = cls._partition_bounds(span, time)
+                name = "{}_{}".format(
+                    parent, lower.strftime(cls._partition_format(span)))
+                db.session.execute(
+                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES "
+                    "FROM ('{}') TO ('{}')"
+                    .format(quote(name), quote(parent), lower, upper))
+                time = upper
+
+    @classmethod
+    def partition_table(cls, days_ahead):
+        """ Converts the slice table into one partitioned by span and then
+        time, copying over the existing slices """
+        quote = db.engine.dialect.identifier_preparer.quote
+        table = cls.__table__.name
+        old = table + "_unpartitioned"
+        first, last = db.session.execute(
+            "SELECT min(time), max(time) FROM {}".format(quote(table))).first()
+        now = datetime.utcnow()
+        last = max(last or now, now + timedelta(days=days_ahead))
+
+        db.session.execute("ALTER TABLE {} RENAME TO {}"
+                           .format(quote(table), quote(old)))
+        db.session.execute("ALTER TABLE {} RENAME CONSTRAINT {} TO {}"
+                           .format(quote(old), quote(table + "_pkey"),
+                                   quote(old + "_pkey")))
+        db.session.execute(
+            "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS, PRIMARY KEY ({})) "
+            "PARTITION BY LIST (span)".format(
+                quote(table), quote(old),
+                ", ".join(quote(col.name) for col in cls.__table__.primary_key)
+                + ", span"))
+        for span in xrange(len(cls.span_config)):
+            db.session.execute(
+                "CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({}) "
+                "PARTITION BY RANGE (time)"
+                .format(quote("{}_s{}".format(table, span)), quote(table), span))
+        cls.create_partitions(first or now, last)
+
+        db.session.execute("INSERT INTO {} SELECT * FROM {}"
+                           .format(quote(table), quote(old)))
+        db.session.execute("DROP TABLE {}".format(quote(old)))
+        for index in cls.__table__.indexes:
+            db.session.execute(str(CreateIndex(index).compile(
+                dialect=db.engine.dialect)))
+
+    @classmethod
+    def _compress_partitions(cls, span, cutoff):
+        """ Rolls up and then drops every partition of `span` that ends
+        before `cutoff`. Compressing whole partitions avoids deleting rows
+        one at a time, at the cost of keeping fine grained slices until
+        their partition ages out. """
+        quote = db.engine.dialect.identifier_preparer.quote
+        for name, start, end in cls._partitions(span):
+            if end > cutoff:
+                break
+            cls._rollup(quote(name), span, "true", {})
+            db.session.execute("DROP TABLE {}".format(quote(name)))
+            db.session.commit()
+            logging.info("Compressed and dropped partition {}".format(name))
+
     @classmethod
     def get_span(cls, lower=None, upper=None, stamp=False, ret_query=False,
-                 slice_size=None, **kwargs):
+                 slice_size=None, grouped=False, **kwargs):
         """ A utility to grab a group of slices and automatically compress
         smaller slices into larger slices
 
         address, worker, and algo are just filters.
         They may be a single string or list of strings.
 
-        upper and lower are datetimes.
+        upper and lower are datetimes. With partitioned storage they also
+        limit which partitions get scanned.
+
+        grouped does the compressing in the database instead, returning the
+        same structure. Values are combined with combine_agg.
         """
         query = db.session.query(cls)
 
@@ -770,7 +1028,6 @@ class TimeSlice(object):
         # Attempt automatic slice size detection... Doesn't work too well
         if slice_size is None:
             if lower:
-                query = query.filter(cls.time >= lower)
                 # Determine which slice size we will use
                 time_in_past = datetime.utcnow() - lower
                 slice_size = None
@@ -788,6 +1045,9 @@ class TimeSlice(object):
         if ret_query:
             return query
 
+        if grouped:
+            return cls._grouped_span(query, slice_size, stamp)
+
         buckets = {}
         for slc in query:
             time = cls.floor_time(slc.time, slice_size, stamp=stamp)
@@ -798,6 +1058,32 @@ class TimeSlice(object):
 
         return buckets.values()
 
+    @classmethod
+    def _grouped_span(cls, query, slice_size, stamp):
+        """ get_span's grouped mode. Buckets the matching slices by key and
+        slice_size in the database and streams the combined rows back """
+        seconds = int(cls.span_config[slice_size]['slice'].total_seconds())
+        bucket = cls._bucket(seconds).label('bucket')
+        columns = [getattr(cls, key) for key in cls.keys]
+        agg = getattr(db.func, cls.combine_agg)
+        rows = (query.with_entities(*(columns + [bucket, agg(cls.value)])).
+                group_by(*(columns + [bucket])).order_by(*columns))
+
+        # Rows come back sorted by key, so each key's values can be built
+        # up as they stream in without any per row objects
+        buckets = []
+        count = len(columns)
+        for key, group in itertools.groupby(rows, lambda row: row[:count]):
+            data = OrderedDict(zip(cls.keys, key))
+            values = {}
+            for row in group:
+                time = int(row[count])
+                if not stamp:
+                    time = datetime.utcfromtimestamp(time)
+                values[time] = row[count + 1]
+            buckets.append({'data': data, 'values': values})
+        return buckets
+
 
 class ShareSlice(TimeSlice, base):
     SHARE_TYPES = ["acc", "low", "dup", "stale"]
@@ -813,11 +1099,58 @@ class ShareSlice(TimeSlice, base):
     value = db.Column(db.Float)
 
     combine = sum_combine
+    combine_sql = "{old} + {new}"
+    combine_agg = "sum"
     keys = ['user', 'worker', 'algo', 'share_type']
     key = namedtuple('Key', keys)
-    span_config = [dict(window=timedelta(hours=1), slice=timedelta(minutes=1)),
-                   dict(window=timedelta(days=1), slice=timedelta(minutes=5)),
-                   dict(window=timedelta(days=30), slice=timedelta(hours=1))]
+    span_config = [dict(window=timedelta(hours=1), slice=timedelta(minutes=1),
+                        partition="day"),
+                   dict(window=timedelta(days=1), slice=timedelta(minutes=5),
+                        partition="day"),
+                   dict(window=timedelta(days=30), slice=timedelta(hours=1),
+                        partition="month")]
+    partitionable = True
+
+
+class PoolShareSlice(TimeSlice, base):
+    """ A rollup of the pool wide share counts that are recorded in
+    ShareSlice under the "pool" user, and per currency under the
+    "pool_currency" user. Kept up to date as shares are collected and
+    compressed, so pool stats don't need to scan every user's slices. """
+    time = db.Column(db.DateTime, primary_key=True)
+    algo = db.Column(db.String, primary_key=True)
+    # Empty for the whole pool
+    currency = db.Column(db.String, primary_key=True)
+    share_type = db.Column(db.Enum(*ShareSlice.SHARE_TYPES, name="share_type"),
+                           primary_key=True)
+
+    span = db.Column(db.SmallInteger, nullable=False)
+    value = db.Column(db.Float)
+
+    combine = sum_combine
+    combine_sql = "{old} + {new}"
+    combine_agg = "sum"
+    keys = ['algo', 'currency', 'share_type']
+    key = namedtuple('Key', keys)
+    span_config = ShareSlice.span_config
+
+    @classmethod
+    def from_share_slices(cls, rows):
+        """ Picks the pool wide slices out of a list of ShareSlice column
+        value dictionaries and converts them to PoolShareSlice ones """
+        pool_rows = []
+        for row in rows:
+            if row['user'] == "pool":
+                currency = ""
+            elif row['user'] == "pool_currency":
+                currency = row['worker']
+            else:
+                continue
+            pool_rows.append(dict(time=row['time'], algo=row['algo'],
+                                  currency=currency,
+                                  share_type=row['share_type'],
+                                  span=row['span'], value=row['value']))
+        return pool_rows
 
 
 class DeviceSlice(TimeSlice, base):
@@ -847,11 +1180,17 @@ class DeviceSlice(TimeSlice, base):
     value = db.Column(db.Float)
 
     combine = average_combine
+    combine_sql = "({old} + {new}) / 2"
+    combine_agg = "avg"
     keys = ['user', 'worker', 'device', 'stat_val']
     key = namedtuple('Key', keys)
-    span_config = [dict(window=timedelta(hours=1), slice=timedelta(minutes=1)),
-                   dict(window=timedelta(days=1), slice=timedelta(minutes=5)),
-                   dict(window=timedelta(days=30), slice=timedelta(hours=1))]
+    span_config = [dict(window=timedelta(hours=1), slice=timedelta(minutes=1),
+                        partition="day"),
+                   dict(window=timedelta(days=1), slice=timedelta(minutes=5),
+                        partition="day"),
+                   dict(window=timedelta(days=30), slice=timedelta(hours=1),
+                        partition="month")]
+    partitionable = True
 
 
 ################################################################################
@@ -1,32 +1,33 @@
 import logging
 import itertools
+import json
 import datetime
 from pprint import pprint
 import time
-from requests import ConnectionError
-import simplejson as json
-import urllib3
 import sqlalchemy
 import decorator
 import argparse
 import decimal
-import bz2
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from simplecoin import (db, cache, redis_conn, create_app, currencies,
                         powerpools, algos, global_config, chains)
 from simplecoin.utils import last_block_time, anon_users, time_format, \
-    get_past_chain_profit
-from simplecoin.exceptions import RemoteException, InvalidAddressException
+    get_past_chain_profit, append_share_history, JSONStream, online_shard, \
+    ONLINE_SHARDS, scan_keys, CRON_TASKS, encode_entries
+from simplecoin.exceptions import InvalidAddressException
 from simplecoin.models import (Block, Credit, UserSettings, TradeRequest,
                                CreditExchange, Payout, ShareSlice, ChainPayout,
-                               DeviceSlice, make_upper_lower)
+                               DeviceSlice, PoolShareSlice, make_upper_lower)
 
 from decimal import Decimal
 from flask import current_app
+from redis import ResponseError
 from flask.ext.script import Manager
 from cryptokit import bits_to_difficulty
 from cryptokit.base58 import address_version
-from cryptokit.rpc import CoinRPCException
 
 SchedulerCommand = Manager(usage='Run timed tasks manually')
 
@@ -44,7 +45,7 @@ def reload_cached():
 def crontab(func, *args, **kwargs):
     """ Handles rolling back SQLAlchemy exceptions to prevent breaking the
     connection for the whole scheduler. Also records timing information into
-    the cache """
+    the cache, along with any dictionary of stats the task returns """
 
     t = time.time()
     res = None
@@ -61,56 +62,157 @@ def crontab(func, *args, **kwargs):
 
     # Update data for viewing in the /crontabs view
     key_name = 'cron_last_run_{}'.format(func.__name__)
-    cache.cache._client.hmset(
-        key_name, dict(runtime=t, time=int(time.time())))
-    cache.cache._client.expire(key_name, 86400)
+    stats = dict(runtime=t, time=int(time.time()))
+    if isinstance(res, dict):
+        stats.update(res)
+    pipe = cache.cache._client.pipeline()
+    pipe.hmset(key_name, stats)
+    pipe.expire(key_name, 86400)
+    pipe.sadd(CRON_TASKS, func.__name__)
+    pipe.execute()
     return res
 
 
+def _paid_credits(cutoff, low):
+    """ Selects the ids of credits above `low` that were paid out in a sent
+    transaction for a block found before `cutoff` """
+    credit = Credit.__table__
+    block = Block.__table__
+    payout = Payout.__table__
+    return (db.select([credit.c.id]).
+            select_from(credit.
+                        join(block, credit.c.block_id == block.c.id).
+                        join(payout, credit.c.payout_id == payout.c.id)).
+            where(credit.c.id > low).
+            where(block.c.found_at < cutoff).
+            where(payout.c.transaction_id != None))
+
+
 @SchedulerCommand.option('-ds', '--dont-simulate', default=False, action="store_true")
 @crontab
 def credit_cleanup(days_ago=7, batch_size=10000, sleep=1, dont_simulate=True):
-    objs_count = 100
-    while objs_count:
-        t = time.time()
-        days_ago_dt = datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)
-        # How inefficient? So inefficient...
-        objs = (Credit.query.filter(Credit.payout_id != None).
-                join(Credit.block, aliased=True).
-                filter(Block.found_at < days_ago_dt).
-                join(Credit.payout, aliased=True).
-                filter(Payout.transaction_id != None).
-                limit(batch_size))
-        if dont_simulate:
-            objs_count = 0
-            ids = []
-            for obj in objs:
-                objs_count += 1
-                ids.append(obj.id)
-                db.session.delete(obj)
-            db.session.commit()
-            db.session.expunge_all()
-            current_app.logger.info("Deleted {:,} old credits in {}s"
-                                    .format(objs_count, time.time() - t))
-        else:
-            objs_count = objs.count()
-            current_app.logger.info("Would've deleted {:,} old credits in {}s"
-                                    .format(objs_count, time.time() - t))
+    """ Deletes credits that have been paid out for more than days_ago days.
+    Credits are deleted in id order, batch_size at a time, each batch in its
+    own transaction with a sleep between them. """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)
+    credit = Credit.__table__
+    exchange = CreditExchange.__table__
+
+    if not dont_simulate:
+        count = db.session.execute(
+            db.select([db.func.count()]).
+            select_from(_paid_credits(cutoff, 0).alias())).scalar()
+        current_app.logger.info("Would've deleted {:,} old credits"
+                                .format(count))
+        return
+
+    stats = dict(credits=0, exchange_credits=0)
+    last_id = 0
+    t = time.time()
+    while True:
+        bt = time.time()
+        # Find where this batch ends, then delete everything up to it
+        page = (_paid_credits(cutoff, last_id).
+                order_by(credit.c.id).limit(batch_size).alias())
+        high_id = db.session.execute(
+            db.select([db.func.max(page.c.id)])).scalar()
+        if high_id is None:
+            break
+        ids = _paid_credits(cutoff, last_id).where(credit.c.id <= high_id)
+
+        # CreditExchange rows reference their credit row, so they go first
+        res = db.session.execute(
+            exchange.delete().where(exchange.c.id.in_(ids)))
+        stats['exchange_credits'] += res.rowcount
+        res = db.session.execute(credit.delete().where(credit.c.id.in_(ids)))
+        stats['credits'] += res.rowcount
+        db.session.commit()
+        current_app.logger.info("Deleted {:,} old credits up to id {:,} in {}"
+                                .format(res.rowcount, high_id,
+                                        time_format(time.time() - bt)))
+        last_id = high_id
 
         # Try not to bog down processes with cleanup tasks...
         time.sleep(sleep)
 
+    stats['cleanup_time'] = time.time() - t
+    return stats
+
 
 @SchedulerCommand.option('-ds', '--dont-simulate', default=False, action="store_true")
 @crontab
 def share_cleanup(dont_simulate=True):
     """ Runs chain_cleanup on each chain. """
+    stats = dict(keys_freed=0, bytes_reclaimed=0)
+    t = time.time()
     for chain in chains.itervalues():
         try:
-            chain_cleanup(chain, dont_simulate)
+            res = chain_cleanup(chain, dont_simulate)
         except Exception:
             current_app.logger.exception(
                 "Unhandled exception cleaning up chain {}".format(chain.id))
+            continue
+        if res:
+            stats['keys_freed'] += res['keys']
+            stats['bytes_reclaimed'] += res['bytes']
+    stats['cleanup_time'] = time.time() - t
+    return stats
+
+
+def _unlink_keys(keys, batch_size):
+    """ Removes keys in batches, returning how many of them existed and
+    roughly how many bytes they used. UNLINK frees the memory outside of
+    redis' main thread, DEL is used instead for servers that lack it. Sizes
+    are best effort, they stop being counted if they can't be read. """
+    unlink = current_app.config['slice_cleanup_unlink']
+    sized = True
+    freed = 0
+    reclaimed = 0
+    for i in xrange(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in batch:
+            pipe.type(key)
+        batch = [key for key, key_type in zip(batch, pipe.execute())
+                 if key_type != "none"]
+        if not batch:
+            continue
+
+        # Size the keys in the same round trip that removes them
+        if sized:
+            for key in batch:
+                pipe.debug_object(key)
+        if unlink:
+            pipe.execute_command("UNLINK", *batch)
+        else:
+            pipe.delete(*batch)
+        try:
+            res = pipe.execute()
+        except ResponseError as e:
+            # Either DEBUG isn't allowed or UNLINK isn't supported. Retrying
+            # the removal on its own tells which, and removes whatever the
+            # pipeline may have left
+            current_app.logger.debug(
+                "Unable to size and remove slices together: {}".format(e))
+            if unlink:
+                try:
+                    redis_conn.execute_command("UNLINK", *batch)
+                    sized = False
+                except ResponseError:
+                    current_app.logger.warn(
+                        "UNLINK failed, falling back to DEL", exc_info=True)
+                    unlink = False
+            else:
+                sized = False
+            if not unlink:
+                redis_conn.delete(*batch)
+            freed += len(batch)
+            continue
+        if sized:
+            reclaimed += sum(int(info['serializedlength'])
+                             for info in res[:-1])
+        freed += res[-1]
+    return freed, reclaimed
 
 
 def chain_cleanup(chain, dont_simulate):
@@ -155,29 +257,20 @@ def chain_cleanup(chain, dont_simulate):
         "Keeping {:,} shares based on max diff {} for {} on chain {}"
         .format(shares_to_keep, max_diff, max_diff_currency, chain.id))
 
-    # Delete any shares past shares_to_keep
+    # Delete any shares past shares_to_keep. Uncompressed slices are
+    # registered without a share count, so they don't count towards it
+    chain.register_slices(current_index)
+    swept = chain.sweep_slices()
+    if swept:
+        current_app.logger.info(
+            "Registered {:,} share slices on chain {} that were written out "
+            "of order".format(len(swept), chain.id))
     found_shares = 0
-    empty_slices = 0
     iterations = 0
-    for index in xrange(current_index, -1, -1):
+    for index, state, total_shares in chain.registered_slices(current_index):
         iterations += 1
-        slc_key = "chain_{}_slice_{}".format(chain.id, index)
-        key_type = redis_conn.type(slc_key)
-
-        # Fetch slice information
-        if key_type == "list":
-            empty_slices = 0
-            # For speed sake, ignore uncompressed slices
-            continue
-        elif key_type == "hash":
-            empty_slices = 0
-            found_shares += float(redis_conn.hget(slc_key, "total_shares"))
-        elif key_type == "none":
-            empty_slices += 1
-        else:
-            raise Exception("Unexpected slice key type {}".format(key_type))
-
-        if found_shares >= shares_to_keep or empty_slices >= 20:
+        found_shares += total_shares
+        if found_shares >= shares_to_keep:
             break
 
     if found_shares < shares_to_keep:
@@ -189,30 +282,33 @@ def chain_cleanup(chain, dont_simulate):
     current_app.logger.info("Found {:,} shares after {:,} iterations"
                             .format(found_shares, iterations))
 
-    # Delete all share slices older than the last index found
+    # Delete all share slices from the oldest registered one up to the last
+    # index found
     oldest_kept = index - 1
-    empty_found = 0
-    deleted_count = 0
-    for index in xrange(oldest_kept, -1, -1):
-        if empty_found >= 20:
-            current_app.logger.debug("20 empty in a row, exiting")
-            break
-        key = "chain_{}_slice_{}".format(chain, index)
-        if redis_conn.type(key) == "none":
-            empty_found += 1
-        else:
-            empty_found = 0
-
-            if dont_simulate:
-                if redis_conn.delete(key):
-                    deleted_count += 1
-            else:
-                current_app.logger.info("Would delete {}".format(key))
-
-    if dont_simulate:
+    lowest = chain.lowest_slice()
+    if lowest is None or lowest > oldest_kept:
+        current_app.logger.info("No share slices to delete on chain {}"
+                                .format(chain.id))
+        return
+    keys = ["chain_{}_slice_{}".format(chain.id, index)
+            for index in xrange(oldest_kept, lowest - 1, -1)]
+    if not dont_simulate:
         current_app.logger.info(
-            "Deleted {} total share slices from #{:,}->{:,}"
-            .format(deleted_count, oldest_kept, index))
+            "Would delete {:,} share slices #{:,} -> #{:,}"
+            .format(len(keys), oldest_kept, lowest))
+        return
+
+    # Fold the slices about to be deleted into the accumulator floor
+    chain.trim_accumulator(oldest_kept)
+    t = time.time()
+    freed, reclaimed = _unlink_keys(
+        keys, current_app.config['slice_cleanup_batch_size'])
+    chain.unregister_slices(oldest_kept)
+    current_app.logger.info(
+        "Deleted {:,} total share slices from #{:,} down, reclaiming {:,} "
+        "bytes in {}".format(freed, oldest_kept, reclaimed,
+                             time_format(time.time() - t)))
+    return dict(keys=freed, bytes=reclaimed)
 
 
 @SchedulerCommand.command
@@ -278,35 +374,155 @@ def cache_profitability():
                   btc_per, timeout=3600 * 8)
 
 
-@SchedulerCommand.command
-@crontab
-def update_online_workers():
+def _cache_set_many(entries, online=None, failed=()):
+    """ Writes a list of (key, value, timeout) entries to the cache in a
+    single pipeline, along with the online worker map if one is given """
+    pipe = cache.cache._client.pipeline()
+    for key, value, timeout in entries:
+        pipe.setex(cache.cache.key_prefix + key,
+                   cache.cache.dump_object(value), timeout)
+    if online is not None:
+        _queue_online_workers(pipe, online, failed=failed)
+    pipe.execute()
+
+
+def _queue_online_workers(pipe, users, failed=()):
+    """ Queues replacing the online worker map on a pipeline. Each shard is
+    rewritten whole, and shards left without any addresses are removed.
+
+    `failed` is the ids of powerpools that couldn't be polled. The
+    connections they last reported are folded into users, and shards that
+    already exist keep their expiry, so those connections are kept until
+    660 seconds after the last complete poll. """
+    client = cache.cache._client
+    current = client.smembers(ONLINE_SHARDS)
+    ttls = {}
+    if failed:
+        current = list(current)
+        reads = client.pipeline(transaction=False)
+        for key in current:
+            reads.hgetall(key)
+            reads.ttl(key)
+        res = reads.execute()
+        for key, addresses, ttl in zip(current, res[::2], res[1::2]):
+            ttls[key] = ttl
+            for address, workers in addresses.iteritems():
+                for worker, servers in json.loads(workers).iteritems():
+                    for ppid, count in servers.iteritems():
+                        if int(ppid) in failed:
+                            (users.setdefault(address, {}).
+                             setdefault(worker, {})[int(ppid)]) = count
+
+    shards = {}
+    for address, workers in users.iteritems():
+        shards.setdefault(online_shard(address), {})[address] = json.dumps(workers)
+
+    stale = set(current) - set(shards)
+    if stale:
+        pipe.delete(*stale)
+    for key, addresses in shards.iteritems():
+        pipe.delete(key)
+        pipe.hmset(key, addresses)
+        ttl = ttls.get(key)
+        pipe.expire(key, ttl if ttl > 0 else 660)
+    pipe.delete(ONLINE_SHARDS)
+    if shards:
+        pipe.sadd(ONLINE_SHARDS, *shards)
+        pipe.expire(ONLINE_SHARDS, 660)
+
+
+def _count_clients(response):
+    """ Streams the clients/ view of a powerpool monitor, counting the
+    connections of each address and worker as they're read so the whole
+    listing is never held in memory. Returns {address: {worker: count}}. """
+    stream = JSONStream(response.iter_content(65536))
+    counts = {}
+    for key in stream.items():
+        if key != "clients":
+            stream.value()
+            continue
+
+        for address in stream.items():
+            workers = counts.setdefault(address, {})
+            # Connections are either a list, or a dictionary keyed by id
+            if stream.peek() == '{':
+                members = stream.items()
+            else:
+                members = stream.elements()
+            for _ in members:
+                connection = stream.value()
+                if isinstance(connection, basestring):
+                    continue
+                worker = connection['worker']
+                workers[worker] = workers.get(worker, 0) + 1
+    return counts
+
+
+# Fetches the clients/ view through _count_clients
+CLIENTS_REQUEST = ('clients/', dict(handler=_count_clients))
+
+
+def _online_workers(results):
     """
-    Grabs data on all currently connected clients. Forms a dictionary of this form:
+    Takes the connection counts from each powerpool monitor, as given by
+    _count_clients through PowerPoolKeeper.request_all, and forms a dictionary
+    of this form:
         dict(address=dict(worker_name=dict(powerpool_id=connection_count)))
-    And caches each addresses connection summary as a single cache key.
     """
     users = {}
-    for ppid, powerpool in powerpools.iteritems():
-        try:
-            data = powerpool.request('clients/')
-        except (RemoteException, ConnectionError):
-            current_app.logger.warn("Unable to connect to PP {} to gather worker summary."
-                                    .format(powerpool.full_info()), exc_info=True)
+    for powerpool, (counts, error) in results.iteritems():
+        ppid = powerpool.key
+        if error is not None:
+            current_app.logger.warn("Unable to connect to PP {} to gather worker summary: {}"
+                                    .format(powerpool.full_info(), error))
             continue
 
-        for address, connections in data['clients'].iteritems():
-            user = users.setdefault('addr_online_' + address, {})
-            if isinstance(connections, dict):
-                connections = connections.itervalues()
-            for connection in connections:
-                if isinstance(connection, basestring):
-                    continue
-                worker = user.setdefault(connection['worker'], {})
+        for address, workers in counts.iteritems():
+            user = users.setdefault(address, {})
+            for worker_name, count in workers.iteritems():
+                worker = user.setdefault(worker_name, {})
                 worker.setdefault(ppid, 0)
-                worker[ppid] += 1
+                worker[ppid] += count
+
+    return users
 
-    cache.set_many(users, timeout=660)
+
+@SchedulerCommand.command
+@crontab
+def update_online_workers():
+    """
+    Grabs data on all currently connected clients and caches each addresses
+    connection summary in the online worker map.
+    """
+    results = powerpools.request_all('clients/', handler=_count_clients)
+    failed = set(powerpool.key for powerpool, (_, error)
+                 in results.iteritems() if error is not None)
+    _cache_set_many([], online=_online_workers(results), failed=failed)
+
+
+@SchedulerCommand.command
+@crontab
+def poll_monitors():
+    """
+    Fetches both the clients/ and status views from every powerpool monitor
+    at once, doing the work of update_online_workers and server_status in
+    one pass and one cache write.
+    """
+    clients = {}
+    status = {}
+    errors = 0
+    for powerpool, (client_res, status_res) in \
+            powerpools.request_each([CLIENTS_REQUEST, '']).iteritems():
+        clients[powerpool] = client_res
+        status[powerpool] = status_res
+        errors += (client_res[1] is not None) + (status_res[1] is not None)
+
+    online = _online_workers(clients)
+    # Keep what failed monitors last reported until it expires
+    failed = set(powerpool.key for powerpool, (_, error)
+                 in clients.iteritems() if error is not None)
+    _cache_set_many(_server_status(status), online=online, failed=failed)
+    return dict(monitors=len(status), errors=errors, addresses=len(online))
 
 
 @SchedulerCommand.command
@@ -504,21 +720,109 @@ def leaderboard():
     cache.set("leaderboard", sorted_users, timeout=15 * 60)
 
 
+def _record_rpc_stats(currency, latency, error=None):
+    """ Keeps running call, error and latency counters for a currency's
+    coinserver, shown on the /crontabs page """
+    key = "{}_rpc_stats".format(currency.key)
+    pipe = cache.cache._client.pipeline()
+    pipe.hincrby(key, "calls", 1)
+    pipe.hincrbyfloat(key, "latency_total", latency)
+    pipe.hset(key, "latency", latency)
+    if error is not None:
+        pipe.hincrby(key, "errors", 1)
+        pipe.hset(key, "last_error", "{}: {}".format(type(error).__name__, error))
+    pipe.execute()
+
+
+def _rpc_fanout(calls):
+    """
+    Runs a list of (currency, function) pairs on a thread pool, yielding
+    (currency, result, error) as each call finishes. Calls that haven't
+    finished network_rpc_timeout seconds after they started running are
+    given up on and yielded with a TimeoutError. Latency and errors are
+    recorded for each currency whose call got to run.
+    """
+    if not calls:
+        return
+
+    started = {}
+    app = current_app._get_current_object()
+
+    def call(job):
+        idx, func = job
+        with app.app_context():
+            t = started[idx] = time.time()
+            try:
+                return idx, func(), None, time.time() - t
+            except Exception as e:
+                return idx, None, e, time.time() - t
+
+    timeout = current_app.config['network_rpc_timeout']
+    threads = min(current_app.config['network_rpc_threads'], len(calls))
+    pending = dict(enumerate(currency for currency, _ in calls))
+    # Calls that were given up on, but are still holding a thread
+    hung = set()
+    pool = ThreadPool(threads)
+    try:
+        results = pool.imap_unordered(call, enumerate(func for _, func in calls))
+        while pending:
+            deadlines = [started[idx] + timeout for idx in pending
+                         if idx in started]
+            wait = min(deadlines) - time.time() if deadlines else timeout
+            try:
+                idx, res, error, latency = results.next(max(wait, 0))
+            except multiprocessing.TimeoutError:
+                now = time.time()
+                for idx in pending.keys():
+                    if idx in started and started[idx] + timeout <= now:
+                        currency = pending.pop(idx)
+                        hung.add(idx)
+                        error = multiprocessing.TimeoutError(
+                            "No response in {} seconds".format(timeout))
+                        _record_rpc_stats(currency, timeout, error)
+                        yield currency, None, error
+                # With every thread stuck, the calls still queued can't
+                # start until a coinserver times out
+                if len(hung) >= threads:
+                    break
+                continue
+
+            if idx in hung:
+                hung.discard(idx)
+                continue
+            currency = pending.pop(idx)
+            _record_rpc_stats(currency, latency, error)
+            yield currency, res, error
+    finally:
+        # Drop the calls that never started and wait out the hung ones, which
+        # end when their coinserver request times out, so that none of them
+        # overlap with the next run
+        pool.terminate()
+        pool.join()
+
+    for currency in pending.itervalues():
+        yield currency, None, multiprocessing.TimeoutError(
+            "Never started, all {} threads were waiting on other coinservers"
+            .format(threads))
+
+
 @SchedulerCommand.command
 @crontab
 def update_network():
     """
     Queries the RPC servers confirmed to update network stats information.
+    All the coinservers are queried at once and each currency is updated as
+    its response arrives.
     """
-    for currency in currencies.itervalues():
-        if not currency.mineable:
-            continue
+    calls = [(currency, functools.partial(currency.coinserv.getblocktemplate, {}))
+             for currency in currencies.itervalues() if currency.mineable]
 
-        try:
-            gbt = currency.coinserv.getblocktemplate({})
-        except (urllib3.exceptions.HTTPError, CoinRPCException) as e:
+    errors = 0
+    for currency, gbt, error in _rpc_fanout(calls):
+        if error is not None:
             current_app.logger.error("Unable to communicate with {} RPC server: {}"
-                                     .format(currency, e))
+                                     .format(currency, error))
+            errors += 1
             continue
 
         key = "{}_data".format(currency.key)
@@ -551,6 +855,8 @@ def update_network():
                        difficulty_avg_stale=len(diff_list) < keep_count),
                   timeout=1200)
 
+    return dict(currencies=len(calls), errors=errors)
+
 
 @SchedulerCommand.option("-b", "--block-id", type=int, dest="block_id")
 @crontab
@@ -563,20 +869,11 @@ def update_block_state(block_id=None):
 
     First checks to see if blocks are orphaned,
     then it checks to see if they are now matured.
-    """
-    heights = {}
-
-    def get_blockheight(currency):
-        if currency.key not in heights:
-            try:
-                heights[currency.key] = currency.coinserv.getblockcount()
-            except Exception as e:
-                current_app.logger.error(
-                    "Unable to communicate with {} RPC server: {}"
-                    .format(currency.key, e))
-                heights[currency.key] = None
-        return heights[currency.key]
 
+    Each currency's blocks are checked with one batch request, and all the
+    currencies are checked at once. The changes are written with one UPDATE
+    per outcome.
+    """
     # Select immature & non-orphaned blocks if none are passed
     if block_id is None:
         blocks = Block.query.filter_by(mature=False, orphan=False).all()
@@ -585,69 +882,99 @@ def update_block_state(block_id=None):
         blocks = (Block.query.filter_by(currency=block.currency)
                              .filter(Block.id >= block_id).all())
 
+    by_currency = {}
     for block in blocks:
-        try:
-            currency = currencies[block.currency]
-        except KeyError:
+        if block.currency not in currencies:
             current_app.logger.error(
                 "Unable to process block {}, no currency configuration."
                 .format(block))
             continue
+        by_currency.setdefault(block.currency, []).append(block)
 
-        blockheight = get_blockheight(currency)
+    heights = {}
+    calls = [(currencies[key], currencies[key].coinserv.getblockcount)
+             for key in by_currency]
+    for currency, height, error in _rpc_fanout(calls):
+        if error is not None:
+            current_app.logger.error(
+                "Unable to communicate with {} RPC server: {}"
+                .format(currency.key, error))
+            continue
+        heights[currency.key] = height
 
+    checks = {}
+    for key, currency_blocks in by_currency.iteritems():
+        currency = currencies[key]
+        blockheight = heights.get(key)
         if not blockheight:
-            current_app.logger.warn("Skipping block state update because we "
-                                    "failed trying to poll the RPC!")
+            current_app.logger.warn("Skipping {} block state update because "
+                                    "we failed trying to poll the RPC!"
+                                    .format(key))
             continue
 
-        # Skip checking if height difference isn't sufficient. Avoids polling
-        # the RPC server excessively
-        if (blockheight - block.height) < currency.block_mature_confirms:
-            current_app.logger.debug(
-                "Not doing confirm check on block {} since it's not at check "
-                "threshold (last height {})".format(block, blockheight))
+        for block in currency_blocks:
+            # Skip checking if height difference isn't sufficient. Avoids
+            # polling the RPC server excessively
+            if (blockheight - block.height) < currency.block_mature_confirms:
+                current_app.logger.debug(
+                    "Not doing confirm check on block {} since it's not at check "
+                    "threshold (last height {})".format(block, blockheight))
+                continue
+            checks.setdefault(key, []).append(block)
+
+    # Check to see if the block hashes exist in the block chain
+    timeout = current_app.config['network_rpc_timeout']
+    calls = [(currencies[key],
+              functools.partial(currencies[key].coinserv_batch,
+                                [("getblock", [block.hash]) for block in currency_blocks],
+                                timeout=timeout))
+             for key, currency_blocks in checks.iteritems()]
+    mature = []
+    orphan = []
+    for currency, outputs, error in _rpc_fanout(calls):
+        if error is not None:
+            current_app.logger.error("Unable to communicate with {} RPC server:"
+                                     " {}".format(currency.key, error))
             continue
 
-        try:
-            # Check to see if the block hash exists in the block chain
-            output = currency.coinserv.getblock(block.hash)
+        for block, (output, error) in zip(checks[currency.key], outputs):
+            if error is not None:
+                current_app.logger.info(
+                    "Block {} not in coin database, assume orphan!".format(block))
+                orphan.append(block.id)
+                continue
+
             current_app.logger.debug(
                 "Confirms: {}; Height diff: {}"
-                .format(output['confirmations'], blockheight - block.height))
-        except urllib3.exceptions.HTTPError as e:
-            current_app.logger.error("Unable to communicate with {} RPC server:"
-                                     " {}".format(currency.key, e))
-            continue
-        except CoinRPCException:
-            current_app.logger.info(
-                "Block {} not in coin database, assume orphan!".format(block))
-            block.orphan = True
-            block.mature = False
-            for credit in block.credits:
-                credit.payable = False
-        else:
+                .format(output['confirmations'],
+                        heights[currency.key] - block.height))
             # if the block has the proper number of confirms
             if output['confirmations'] >= currency.block_mature_confirms:
                 current_app.logger.info(
                     "Block {} meets {} confirms, mark mature"
                     .format(block, currency.block_mature_confirms))
-                block.mature = True
-                block.orhpan = False
-                for credit in block.credits:
-                    if credit.type == 0:
-                        credit.payable = True
+                mature.append(block.id)
             # else if the result shows insufficient confirms, mark orphan
-            elif output['confirmations'] < currency.block_mature_confirms:
+            else:
                 current_app.logger.info(
                     "Block {} occured {} height ago, but not enough confirms. "
                     "Marking orphan.".format(block, currency.block_mature_confirms))
-                block.orphan = True
-                block.mature = False
-                for credit in block.credits:
-                    credit.payable = False
+                orphan.append(block.id)
+
+    if orphan:
+        (Block.query.filter(Block.id.in_(orphan))
+         .update(dict(orphan=True, mature=False), synchronize_session=False))
+        (Credit.query.filter(Credit.block_id.in_(orphan))
+         .update(dict(payable=False), synchronize_session=False))
+    if mature:
+        (Block.query.filter(Block.id.in_(mature))
+         .update(dict(mature=True, orphan=False), synchronize_session=False))
+        (Credit.query.filter(Credit.block_id.in_(mature), Credit.type == 0)
+         .update(dict(payable=True), synchronize_session=False))
+    db.session.commit()
 
-        db.session.commit()
+    return dict(checked=sum(len(b) for b in checks.itervalues()),
+                mature=len(mature), orphan=len(orphan))
 
 
 @SchedulerCommand.option('-ds', '--dont-simulate', default=False, action="store_true")
@@ -656,7 +983,7 @@ def generate_credits(dont_simulate=True):
     """ Loops through all the blocks that haven't been credited out and
     attempts to process them """
     simulate = not dont_simulate
-    unproc_blocks = redis_conn.keys("unproc_block*")
+    unproc_blocks = scan_keys("unproc_block*")
     for key in unproc_blocks:
         hash = key[13:]
         current_app.logger.info("==== Attempting to process block hash {}"
@@ -674,7 +1001,124 @@ def generate_credits(dont_simulate=True):
 def distributor(*args, **kwargs):
     if not kwargs.get('scale'):
         kwargs['scale'] = current_app.MAX_DECIMALS
-    return _distributor(*args, **kwargs)
+    if current_app.config['distributor_engine'] == "decimal":
+        return _distributor(*args, **kwargs)
+    return _int_distributor(*args, **kwargs)
+
+
+def _truncate(num, den, prec):
+    """ Returns the positive fraction num / den truncated to `prec`
+    significant digits, as a (coefficient, exponent) pair. This is what a
+    Decimal division does with ROUND_DOWN. """
+    if num == 0:
+        return 0, 0
+    shift = prec - (len(str(num)) - len(str(den)))
+    for shift in (shift, shift - 1):
+        if shift >= 0:
+            coef = (num * 10 ** shift) // den
+        else:
+            coef = num // (den * 10 ** -shift)
+        if coef < 10 ** prec:
+            return coef, -shift
+
+
+def _int_distributor(amount, splits, scale=None, addtl_prec=0):
+    """ Gives exactly the same results as _distributor, but does the
+    arithmetic on integers instead of Decimals, which is much quicker with
+    thousands of splits. Every Decimal operation in _distributor is mirrored
+    on (coefficient, exponent) pairs, including truncating to the working
+    precision, so the remainders (and therefore who gets the leftovers) come
+    out identical. Split values must not be negative. """
+    scale = int(scale or 28)
+    amount = Decimal(amount)
+
+    if not splits:
+        raise Exception("Splits cannot be empty!")
+
+    with decimal.localcontext(decimal.BasicContext) as ctx:
+        ctx.rounding = decimal.ROUND_DOWN
+        # Same working precision as _distributor
+        prec = len(str(int(round(amount)))) + scale + addtl_prec
+        ctx.prec = prec
+
+        # Round the distribution amount to correct scale. We will distribute
+        # exactly this much
+        new_amount = amount.quantize(Decimal((0, (1, ), -scale)))
+        assert abs(amount - new_amount) < (amount / 10000)
+        sign, digits, exponent = new_amount.as_tuple()
+        amount_units = int("".join(map(str, digits)))
+        amount_exp = -scale
+
+    keys = splits.keys()
+    values = []
+    for key in keys:
+        value = splits[key]
+        if isinstance(value, Decimal):
+            sign, digits, exponent = value.as_tuple()
+            assert not sign and isinstance(exponent, int)
+            values.append((int("".join(map(str, digits))), exponent))
+        else:
+            assert isinstance(value, (int, long)) and value >= 0
+            values.append((value, 0))
+
+    # The total is a plain sum until a Decimal is added, after which every
+    # addition truncates to the working precision
+    total, total_exp = 0, 0
+    rounding = False
+    for key, (coef, exponent) in zip(keys, values):
+        rounding = rounding or isinstance(splits[key], Decimal)
+        low = min(total_exp, exponent)
+        total = total * 10 ** (total_exp - low) + coef * 10 ** (exponent - low)
+        total_exp = low
+        if rounding and total_exp < 0:
+            total, total_exp = _truncate(total, 10 ** -total_exp, prec)
+        elif rounding:
+            total, total_exp = _truncate(total * 10 ** total_exp, 1, prec)
+    if total == 0:
+        raise decimal.DivisionByZero("Splits add up to zero")
+
+    # share = (value / total) * amount, truncated at each step
+    shares = []
+    for coef, exponent in values:
+        shift = exponent - total_exp
+        if shift >= 0:
+            coef, exponent = _truncate(coef * 10 ** shift, total, prec)
+        else:
+            coef, exponent = _truncate(coef, total * 10 ** -shift, prec)
+        coef *= amount_units
+        exponent += amount_exp
+        excess = len(str(coef)) - prec
+        if excess > 0:
+            coef //= 10 ** excess
+            exponent += excess
+        shares.append((coef, exponent))
+
+    # Round each share down to `scale` places, remembering the remainders at a
+    # common exponent so they can be compared
+    low = min([exponent for coef, exponent in shares] + [-scale])
+    units = {}
+    remainders = {}
+    for key, (coef, exponent) in zip(keys, shares):
+        if exponent + scale >= 0:
+            units[key] = coef * 10 ** (exponent + scale)
+        else:
+            units[key] = coef // 10 ** -(exponent + scale)
+        remainders[key] = (coef * 10 ** (exponent - low) -
+                           units[key] * 10 ** (-scale - low))
+
+    # The amount that hasn't been distributed due to rounding down, handed
+    # out round robin in remainder order just like _distributor
+    count = amount_units - sum(units.itervalues())
+    assert count >= 0
+    if count != 0:
+        keylist = sorted(remainders.iterkeys(), key=remainders.get, reverse=True)
+        full, extra = divmod(count, len(keylist))
+        for i, key in enumerate(keylist):
+            units[key] += full + (1 if i < extra else 0)
+
+    for key in keys:
+        splits[key] = Decimal("{}E-{}".format(units[key], scale))
+    return splits
 
 
 def _distributor(amount, splits, scale=None, addtl_prec=0):
@@ -751,6 +1195,38 @@ def _distributor(amount, splits, scale=None, addtl_prec=0):
         return splits
 
 
+def _calc_chain_shares(chain_payouts):
+    """
+    Fetches the share distribution for each of the ChainPayouts, returning
+    them in the same order. The share windows are worked out up front since
+    they may need the database, then the redis bound calculations run
+    concurrently on a thread pool.
+    """
+    jobs = [(cpo, cpo.config_obj.share_window(cpo)) for cpo in chain_payouts]
+    threads = min(current_app.config['share_calc_threads'], len(jobs))
+    if threads <= 1:
+        return [cpo.config_obj.calc_shares(cpo, window) for cpo, window in jobs]
+
+    app = current_app._get_current_object()
+    context = decimal.getcontext()
+
+    def calc(job):
+        cpo, window = job
+        # Decimal contexts are per thread, so carry ours over to keep the
+        # results identical to running them in sequence. Each thread checks
+        # out its own connection from the redis connection pool.
+        decimal.setcontext(context.copy())
+        with app.app_context():
+            return cpo.config_obj.calc_shares(cpo, window)
+
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(calc, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def credit_block(redis_key, simulate=False):
     """
     Calculates credits for users from share records for the latest found block.
@@ -840,9 +1316,8 @@ def credit_block(redis_key, simulate=False):
 
     # Fetch the share distribution for this payout chain
     users = set()
-    for chain in chains:
-        # Actually fetch the shares from redis!
-        chain.user_shares = chain.config_obj.calc_shares(chain)
+    for chain, user_shares in zip(chains, _calc_chain_shares(chains)):
+        chain.user_shares = user_shares
         # If we have nothing, default to paying out the block finder everything
         if not chain.user_shares:
             chain.user_shares[block.user] = 1
@@ -932,60 +1407,57 @@ def credit_block(redis_key, simulate=False):
         chain_fee_perc = chain.config_obj.fee_perc
         for key, credit in chain.credits.items():
             # don't try to payout users with zero payout
-            if credit.amount == 0:
-                db.session.expunge(credit)
+            if credit['amount'] == 0:
                 del chain.credits[key]
                 continue
 
             # Skip fees/donations for the pool address
-            if credit.user == pool_payout['user']:
+            if credit['user'] == pool_payout['user']:
                 continue
 
             # To do a final check of payout amount
-            paid += credit.amount
+            paid += credit['amount']
 
             # Fee/donation/bonus lookup
             fee_perc = chain_fee_perc
             donate_perc = Decimal('0')
-            settings = custom_settings.get(credit.user)
+            settings = custom_settings.get(credit['user'])
             if settings:
                 donate_perc = settings.pdonation_perc
 
             # Application
             assert isinstance(fee_perc, Decimal)
             assert isinstance(donate_perc, Decimal)
-            fee_amount = credit.amount * fee_perc
-            donate_amount = credit.amount * donate_perc
-            credit.amount -= fee_amount
-            credit.amount -= donate_amount
+            fee_amount = credit['amount'] * fee_perc
+            donate_amount = credit['amount'] * donate_perc
+            credit['amount'] -= fee_amount
+            credit['amount'] -= donate_amount
 
             # Recording
-            credit.fee_perc = int(fee_perc * 100)
-            credit.pd_perc = int(donate_perc * 100)
+            credit['fee_perc'] = int(fee_perc * 100)
+            credit['pd_perc'] = int(donate_perc * 100)
 
             # Bookkeeping
             donations_collected += donate_amount
             fees_collected += fee_amount
 
+    rows = [credit for chain in chains for credit in chain.credits.itervalues()]
     if fees_collected > 0:
-        p = Credit.make_credit(
-            user=pool_payout['user'],
-            block=block,
-            currency=pool_payout['currency'].key,
-            source=1,
-            address=pool_payout['address'],
-            amount=+fees_collected)
-        db.session.add(p)
+        rows.append(dict(user=pool_payout['user'],
+                         currency=pool_payout['currency'].key,
+                         source=1,
+                         address=pool_payout['address'],
+                         amount=+fees_collected))
 
     if donations_collected > 0:
-        p = Credit.make_credit(
-            user=pool_payout['user'],
-            block=block,
-            currency=pool_payout['currency'].key,
-            source=2,
-            address=pool_payout['address'],
-            amount=+donations_collected)
-        db.session.add(p)
+        rows.append(dict(user=pool_payout['user'],
+                         currency=pool_payout['currency'].key,
+                         source=2,
+                         address=pool_payout['address'],
+                         amount=+donations_collected))
+
+    # Write all the credits at once rather than flushing an object for each
+    Credit.bulk_create(block, rows)
 
     current_app.logger.info("Collected {} {} in donation"
                             .format(donations_collected, block.currency))
@@ -1003,7 +1475,7 @@ def credit_block(redis_key, simulate=False):
             continue
         current_app.logger.info(
             "Collected {} from invalid mining addresses on chain {}"
-            .format(chain.credits[pool_key].amount, chain.chainid))
+            .format(chain.credits[pool_key]['amount'], chain.chainid))
 
     if not simulate:
         db.session.commit()
@@ -1016,13 +1488,20 @@ def credit_block(redis_key, simulate=False):
 @crontab
 def collect_ppagent_data():
     """ Grabs all the pending ppagent data points """
-    _grab_data("temp_*", "temperature")
-    _grab_data("hashrate_*", "hashrate")
+    t = time.time()
+    rows = _grab_data("temp_*", "temperature")
+    rows += _grab_data("hashrate_*", "hashrate")
+    t = time.time() - t
+    return dict(rows=rows, rows_per_sec=int(rows / t) if t else 0)
 
 
 def _grab_data(prefix, stat):
+    """ Writes all the pending ppagent data points for the given stat,
+    returning how many device slices were written """
     proc_name = "processing_{}".format(stat)
-    unproc_mins = redis_conn.keys(prefix)
+    stat_val = DeviceSlice.to_db[stat]
+    unproc_mins = scan_keys(prefix)
+    rows = 0
     for key in unproc_mins:
         current_app.logger.info("Processing key {}".format(key))
         try:
@@ -1039,35 +1518,45 @@ def _grab_data(prefix, stat):
             continue
 
         redis_conn.rename(key, proc_name)
+        slices = []
+        bogus = 0
         for user, value in redis_conn.hgetall(proc_name).iteritems():
             try:
                 address, worker, did = user.split("_")
-                try:
-                    value = float(value)
-                except ValueError:
-                    if value != "None":
-                        current_app.logger.warn(
-                            "Got bogus value {} from ppagent for stat {}"
-                            .format(value, stat), exc_info=True)
-                    continue
-
-                # Megahashes are was cgminer reports
-                if stat == "hashrate":
-                    value *= 1000000
-            except Exception:
+                did = int(did)
+                # Device is stored as a small integer
+                if not 0 <= did < 2 ** 15:
+                    raise ValueError("Device id {} out of range".format(did))
+            except ValueError:
                 current_app.logger.error("Error processing key {} on hash {}"
                                          .format(user, key), exc_info=True)
                 continue
 
             try:
-                slc = DeviceSlice(user=address, time=minute, worker=worker,
-                                  device=did, stat=stat, value=value, span=0)
-                db.session.add(slc)
-                db.session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                current_app.logger.warn("SQLAlchemy collision", exc_info=True)
-                db.session.rollback()
+                value = float(value)
+            except ValueError:
+                if value != "None":
+                    bogus += 1
+                continue
+
+            # Megahashes are was cgminer reports
+            if stat == "hashrate":
+                value *= 1000000
+
+            slices.append(dict(user=address, time=minute, worker=worker,
+                               device=did, stat_val=stat_val, value=value,
+                               span=0))
+
+        if bogus:
+            current_app.logger.warn(
+                "Got {:,} bogus values from ppagent for stat {} in {}"
+                .format(bogus, stat, key))
+
+        # Write the whole minute at once, averaging with any existing slices
+        rows += DeviceSlice.bulk_upsert(slices)
+        db.session.commit()
         redis_conn.delete(proc_name)
+    return rows
 
 
 @SchedulerCommand.command
@@ -1075,7 +1564,10 @@ def _grab_data(prefix, stat):
 def collect_minutes():
     """ Grabs all the pending minute shares out of redis and puts them in the
     database """
-    unproc_mins = redis_conn.keys("min_*")
+    unproc_mins = scan_keys("min_*")
+    t = time.time()
+    rows = 0
+    history = 0
     for key in unproc_mins:
         current_app.logger.info("Processing key {}".format(key))
         share_type, algo, stamp = key.split("_")[1:]
@@ -1088,6 +1580,7 @@ def collect_minutes():
             continue
 
         redis_conn.rename(key, "processing_shares")
+        slices = []
         for user, shares in redis_conn.hgetall("processing_shares").iteritems():
 
             shares = float(shares)
@@ -1108,24 +1601,121 @@ def collect_minutes():
                 if curr is None:
                     address = global_config.pool_payout_currency.pool_payout_addr
 
-            try:
-                slc = ShareSlice(user=address, time=minute, worker=worker, algo=algo,
-                                 share_type=share_type, value=shares, span=0)
-                db.session.add(slc)
-                db.session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                db.session.rollback()
-                slc = ShareSlice.query.with_lockmode('update').filter_by(
-                    user=address, time=minute, worker=worker, algo=algo,
-                    share_type=share_type).one()
-                slc.value += shares
-                db.session.commit()
+            slices.append(dict(user=address, time=minute, worker=worker,
+                               algo=algo, share_type=share_type, value=shares,
+                               span=0))
+
+        # Write the whole minute at once, adding to any existing slices
+        rows += ShareSlice.bulk_upsert(slices)
+        PoolShareSlice.bulk_upsert(PoolShareSlice.from_share_slices(slices))
+        db.session.commit()
         redis_conn.delete("processing_shares")
+        history += append_share_history(slices)
+
+    t = time.time() - t
+    current_app.logger.info("Wrote {:,} share slices in {}"
+                            .format(rows, time_format(t)))
+    return dict(rows=rows, rows_per_sec=int(rows / t) if t else 0,
+                history=history)
+
+
+def _encode_slice(job):
+    """ Runs encode_entries for compress_slices on a pool thread """
+    return encode_entries(*job)
+
+
+def _compress_batch(chain, indexes, encoding, pool, stats):
+    """ Compresses a batch of raw slices for compress_slices, encoding them
+    on `pool` if one is given. Returns {index: entries} for the slices that
+    were compressed. """
+    keys = ["chain_{}_slice_{}".format(chain.id, index) for index in indexes]
+
+    # Retrieve the unencoded information from redis. Only lists are raw data
+    # from powerpools redis reporter
+    t = time.time()
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    raw = [(index, key) for index, key, key_type
+           in zip(indexes, keys, pipe.execute()) if key_type == "list"]
+    if not raw:
+        return {}
+    indexes, keys = zip(*raw)
+    for key in keys:
+        pipe.lrange(key, 0, -1)
+        pipe.debug_object(key)
+    res = pipe.execute()
+    stats['retrieval_time'] += time.time() - t
+
+    # Parse the lists into proper python representation
+    decoded = {}
+    totals = []
+    for index, slice_shares in zip(indexes, res[::2]):
+        data = []
+        total_shares = 0
+        for entry in slice_shares:
+            user, shares = entry.split(":")
+            shares = Decimal(shares)
+            data.append((user, shares))
+            total_shares += shares
+        decoded[index] = data
+        totals.append(total_shares)
+        stats['entry_count'] += len(data)
+    stats['original_size'] += sum(int(info['serializedlength'])
+                                  for info in res[1::2])
+
+    # serialization and compression. Users are interned once for the whole
+    # batch, leaving the pool threads only the packing
+    t = time.time()
+    user_ids = None
+    if encoding == "interned":
+        user_ids = chain.intern_users(
+            user for index in indexes for user, _ in decoded[index])
+    jobs = [(decoded[index], encoding, user_ids) for index in indexes]
+    if pool:
+        encoded = pool.map(_encode_slice, jobs)
+    else:
+        encoded = map(_encode_slice, jobs)
+    stats['encoding_time'] += time.time() - t
+
+    # Put all the new data into temporary keys, then atomically replace the
+    # old list keys. ensures we never loose data, even on failures
+    # (exceptions)
+    pipe = redis_conn.pipeline()
+    for index, key, total_shares, (data, used, error) in zip(
+            indexes, keys, totals, encoded):
+        if error is not None:
+            current_app.logger.warn(
+                "Unable to pack slice #{:,} for chain {}, using bz2json: {}"
+                .format(index, chain.id, error))
+        key_compressed = key + "_compressed"
+        pipe.hmset(key_compressed,
+                   dict(
+                       date=int(time.time()),
+                       data=data,
+                       encoding=used,
+                       total_shares=total_shares)
+                   )
+        pipe.rename(key_compressed, key)
+        chain._queue_slice_state(pipe, index, "compressed", total_shares)
+    pipe.execute()
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.debug_object(key)
+    stats['encoded_size'] += sum(int(info['serializedlength'])
+                                 for info in pipe.execute())
+    stats['slices'] += len(indexes)
+    return decoded
 
 
 @SchedulerCommand.command
 @crontab
 def compress_slices():
+    encoding = current_app.config['slice_encoding']
+    threads = current_app.config['slice_compress_threads']
+    run_stats = dict(slices=0, entries=0)
+    t = time.time()
     for chain in chains.itervalues():
         # Get the index of the last inserted share slice on this chain
         last_complete_slice = redis_conn.get("chain_{}_slice_index".format(chain.id))
@@ -1137,94 +1727,53 @@ def compress_slices():
         else:
             last_complete_slice = int(last_complete_slice)
 
-        # Loop thorugh all possible share slice numbers
-        empty = 0
-        encoding_time = 0.0
-        retrieval_time = 0.0
-        entry_count = 0
-        encoded_size = 0
-        original_size = 0
-        last_slice = last_complete_slice
-        for slc_idx in xrange(last_complete_slice, 0, -1):
-            key = "chain_{}_slice_{}".format(chain.id, slc_idx)
-            key_type = redis_conn.type(key)
-
-            # Compress if it's a list. This is raw data from powerpools redis
-            # reporter
-            if key_type == "list":
-                # Reduce empty counter, but don't go negative
-                empty = max(0, empty - 1)
-
-                # Retrieve the enencoded information from redis
-                t = time.time()
-                slice_shares = redis_conn.lrange(key, 0, -1)
-                this_original_size = int(redis_conn.debug_object(key)['serializedlength'])
-                this_retrieval_time = time.time() - t
-
-                # Parse the list into proper python representation
-                data = []
-                total_shares = 0
-                for entry in slice_shares:
-                    user, shares = entry.split(":")
-                    shares = Decimal(shares)
-                    data.append((user, shares))
-                    total_shares += shares
-                this_entry_count = len(data)
-
-                # serialization and compression
-                t = time.time()
-                data = json.dumps(data, separators=(',', ':'), use_decimal=True)
-                data = bz2.compress(data)
-                this_encoding_time = time.time() - t
-
-                # Put all the new data into a temporary key, then atomically
-                # replace the old list key. ensures we never loose data, even
-                # on failures (exceptions)
-                key_compressed = key + "_compressed"
-                redis_conn.hmset(key_compressed,
-                                 dict(
-                                     date=int(time.time()),
-                                     data=data,
-                                     encoding="bz2json",
-                                     total_shares=total_shares)
-                                 )
-                redis_conn.rename(key_compressed, key)
-                this_encoded_size = int(redis_conn.debug_object(key)['serializedlength'])
-
-                last_slice = slc_idx
-                # Update all the aggregates
-                encoding_time += this_encoding_time
-                retrieval_time += this_retrieval_time
-                entry_count += this_entry_count
-                encoded_size += this_encoded_size
-                original_size += this_original_size
+        # Pick up any new slices, then compress the raw ones in batches
+        raw_slices = chain.register_slices(last_complete_slice)
+        stats = dict(encoding_time=0.0, retrieval_time=0.0, entry_count=0,
+                     encoded_size=0, original_size=0, slices=0)
+        decoded = {}
+        # Only worth starting threads when there's a backlog to spread. bz2
+        # releases the GIL while it compresses
+        pool = None
+        if threads > 1 and len(raw_slices) >= threads * 2:
+            pool = ThreadPool(threads)
+        try:
+            for i in xrange(0, len(raw_slices), chain.slice_batch_size):
+                batch = raw_slices[i:i + chain.slice_batch_size]
+                decoded.update(
+                    _compress_batch(chain, batch, encoding, pool, stats))
                 # Print progress
                 current_app.logger.info(
-                    "Encoded slice #{:,} containing {:,} entries."
-                    " retrieval_time: {}; encoding_time: {}; start_size: {:,}; end_size: {:,}; ratio: {}"
-                    .format(slc_idx, this_entry_count,
-                            time_format(this_retrieval_time),
-                            time_format(this_encoding_time),
-                            this_original_size, this_encoded_size,
-                            float(this_original_size) / (this_encoded_size or 1)))
-
-            # Count an empty entry to detect the end of live slices
-            elif key_type == "none":
-                empty += 1
-
-            # If we've seen a lot of empty slices, probably nothing else to find!
-            if empty >= 20:
-                current_app.logger.info(
-                    "Ended compression search at {}".format(slc_idx))
-                break
+                    "Encoded slices #{:,} -> #{:,}; {:,} entries so far"
+                    .format(batch[0], batch[-1], stats['entry_count']))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
         current_app.logger.info(
-            "Encoded from slice #{:,} -> #{:,} containing {:,} entries."
+            "Encoded {:,} slices from #{:,} containing {:,} entries."
             " retrieval_time: {}; encoding_time: {}; start_size: {:,}; end_size: {:,}; ratio: {}"
-            .format(last_complete_slice, last_slice, entry_count,
-                    time_format(retrieval_time), time_format(encoding_time),
-                    original_size, encoded_size,
-                    float(original_size) / (encoded_size or 1)))
+            .format(stats['slices'], last_complete_slice, stats['entry_count'],
+                    time_format(stats['retrieval_time']),
+                    time_format(stats['encoding_time']),
+                    stats['original_size'], stats['encoded_size'],
+                    float(stats['original_size']) / (stats['encoded_size'] or 1)))
+        run_stats['slices'] += stats['slices']
+        run_stats['entries'] += stats['entry_count']
+
+        # Keep the running share accumulator in step with the newly
+        # compressed slices
+        try:
+            chain.update_accumulator(decoded)
+        except Exception:
+            current_app.logger.exception(
+                "Unhandled exception updating accumulator for chain {}"
+                .format(chain.id))
+
+    t = time.time() - t
+    run_stats['slices_per_sec'] = int(run_stats['slices'] / t) if t else 0
+    return run_stats
 
 
 @SchedulerCommand.command
@@ -1232,6 +1781,7 @@ def compress_slices():
 def compress_minute():
     ShareSlice.compress(0)
     DeviceSlice.compress(0)
+    PoolShareSlice.compress(0)
     db.session.commit()
 
 
@@ -1240,22 +1790,36 @@ def compress_minute():
 def compress_five_minute():
     ShareSlice.compress(1)
     DeviceSlice.compress(1)
+    PoolShareSlice.compress(1)
     db.session.commit()
 
 
 @SchedulerCommand.command
 @crontab
-def server_status():
+def create_slice_partitions():
+    """ Creates share and device slice partitions ahead of time when using
+    partitioned slice storage """
+    if not ShareSlice.partitioned():
+        return
+    now = datetime.datetime.utcnow()
+    end = now + datetime.timedelta(days=current_app.config['slice_partition_ahead'])
+    for cls in (ShareSlice, DeviceSlice):
+        cls.create_partitions(now, end)
+    db.session.commit()
+
+
+def _server_status(results):
     """
-    Periodically poll the backend to get number of workers and other general
-    status information.
+    Takes the status view of each powerpool monitor, as given by
+    PowerPoolKeeper.request_all, and returns the cache entries for the number
+    of workers, hashrates and other general status information.
     """
     past_chain_profit = get_past_chain_profit()
     currency_hashrates = {}
     algo_miners = {}
     servers = {}
     raw_servers = {}
-    for powerpool in powerpools.itervalues():
+    for powerpool, (data, error) in results.iteritems():
 
         server_default = dict(workers=0,
                               miners=0,
@@ -1264,11 +1828,9 @@ def server_status():
                               profit_4d=0,
                               currently_mining='???')
 
-        try:
-            data = powerpool.request('')
-        except Exception:
-            current_app.logger.warn("Couldn't connect to internal monitor {}"
-                                    .format(powerpool.full_info()))
+        if error is not None:
+            current_app.logger.warn("Couldn't connect to internal monitor {}: {}"
+                                    .format(powerpool.full_info(), error))
             continue
         else:
             raw_servers[powerpool.stratum_address] = data
@@ -1296,17 +1858,29 @@ def server_status():
                         currency_hashrates.setdefault(currencies[currency], 0)
                         currency_hashrates[currencies[currency]] += data['hps']
 
+    entries = []
     # Set hashrate to 0 if not located
     for currency in currencies.itervalues():
         hashrate = 0
         if currency in currency_hashrates:
             hashrate = currency_hashrates[currency]
 
-        cache.set('hashrate_' + currency.key, hashrate, timeout=120)
+        entries.append(('hashrate_' + currency.key, hashrate, 120))
+
+    entries.append(('raw_server_status', raw_servers, 1200))
+    entries.append(('server_status', servers, 1200))
+    entries.append(('total_miners', algo_miners, 1200))
+    return entries
 
-    cache.set('raw_server_status', raw_servers, timeout=1200)
-    cache.set('server_status', servers, timeout=1200)
-    cache.set('total_miners', algo_miners, timeout=1200)
+
+@SchedulerCommand.command
+@crontab
+def server_status():
+    """
+    Periodically poll the backend to get number of workers and other general
+    status information.
+    """
+    _cache_set_many(_server_status(powerpools.request_all('')))
 
 
 def main():
@@ -1,7 +1,17 @@
-from simplecoin import db, global_config
+import array
+import datetime
+import time
+
+from simplecoin import db, global_config, cache, algos
 from simplecoin.tests import RedisUnitTest
-from simplecoin.models import ShareSlice, DeviceSlice
+from simplecoin.models import (ShareSlice, DeviceSlice, PoolShareSlice,
+                               make_upper_lower)
 from simplecoin.scheduler import collect_minutes, collect_ppagent_data
+from simplecoin.utils import (get_pool_hashrate, pool_rollup_ready,
+                              share_history, append_share_history,
+                              _update_share_history, SHARE_HISTORY_KEY,
+                              SHARE_HISTORY_LRU, SHARE_HISTORY_SIZE,
+                              SHARE_HISTORY_RETRIES)
 
 
 class TestCollectMinutes(RedisUnitTest):
@@ -27,6 +37,152 @@ class TestCollectMinutes(RedisUnitTest):
         assert sl_donate.value == 2.4
         assert sl_donate.share_type == "acc"
 
+    def test_collect_upsert(self):
+        """ Shares for a minute that already has slices get added on, as do
+        multiple workers that map to the same slice """
+        self.test_collect()
+        self.app.redis.hmset("min_acc_scrypt_1409899740",
+                             {"pool.": "1.5", "donate.": "1", "invalid.": "2"})
+
+        collect_minutes()
+
+        db.session.rollback()
+        db.session.expunge_all()
+        sl_pool = ShareSlice.query.filter_by(user="pool").one()
+        sl_donate = ShareSlice.query.filter_by(
+            user=global_config.pool_payout_currency.pool_payout_addr).one()
+        self.assertEqual(sl_pool.value, 3.9)
+        self.assertEqual(sl_donate.value, 5.4)
+        stats = cache.cache._client.hgetall("cron_last_run_collect_minutes")
+        self.assertEqual(stats['rows'], "2")
+
+    def test_collect_pool_rollup(self):
+        """ Pool wide slices are rolled up by algo and currency """
+        self.app.redis.hmset("min_acc_scrypt_1409899740",
+                             {"pool.": "2.4", "pool_currency.LTC": "1.5",
+                              "donate.": "3"})
+
+        collect_minutes()
+
+        db.session.rollback()
+        db.session.expunge_all()
+        rollups = {(slc.currency, slc.share_type): slc.value
+                   for slc in PoolShareSlice.query.filter_by(algo="scrypt")}
+        self.assertEqual(rollups, {("", "acc"): 2.4, ("LTC", "acc"): 1.5})
+
+    def test_pool_hashrate_before_backfill(self):
+        """ Pool hashrate is read from the share slices until the rollup
+        goes back as far as they do """
+        lower, upper = make_upper_lower(offset=datetime.timedelta(minutes=2))
+        lower += datetime.timedelta(minutes=1)
+        db.session.add(ShareSlice(time=lower, value=600, user="pool",
+                                  worker="", algo="scrypt", span=0,
+                                  share_type="acc"))
+        db.session.add(PoolShareSlice(time=upper, value=60, algo="scrypt",
+                                      currency="", span=0, share_type="acc"))
+        db.session.commit()
+        hps = algos["scrypt"].hashes_per_share
+        self.assertEqual(get_pool_hashrate("scrypt"), hps)
+
+        # Once backfilled the rollup is used
+        db.session.add(PoolShareSlice(time=lower, value=600, algo="scrypt",
+                                      currency="", span=0, share_type="acc"))
+        db.session.commit()
+        cache.delete_memoized(pool_rollup_ready)
+        cache.delete_memoized(get_pool_hashrate)
+        self.assertTrue(pool_rollup_ready())
+        self.assertEqual(get_pool_hashrate("scrypt"), hps * 1.1)
+
+    def test_collect_share_history(self):
+        """ Viewed users have their cached chart history added to as shares
+        are collected """
+        minute = int(time.time()) // 60 * 60 - 120
+        db.session.add(ShareSlice(
+            time=datetime.datetime.utcfromtimestamp(minute), value=3,
+            user="pool", worker="", algo="scrypt", span=0, share_type="acc"))
+        db.session.commit()
+
+        res = share_history(user=["pool"])
+        self.assertEqual(res[0]['values'], {minute: 3})
+
+        self.app.redis.hmset("min_acc_scrypt_{}".format(minute),
+                             {"pool.": "1.5", "donate.": "1"})
+        self.app.redis.hmset("min_acc_scrypt_{}".format(minute + 60),
+                             {"pool.": "2"})
+        collect_minutes()
+
+        res = share_history(user=["pool"], share_type=["acc"])
+        self.assertEqual(res[0]['values'], {minute: 4.5, minute + 60: 2})
+        res = share_history(user=["pool"], lower=minute + 60)
+        self.assertEqual(res[0]['values'], {minute + 60: 2})
+        self.assertEqual(share_history(user=["pool"], worker=["rig"]), [])
+
+    def test_share_history_collected_during_load(self):
+        """ Minutes collected while a user's history is loading are merged
+        into what gets cached """
+        minute = int(time.time()) // 60 * 60 - 120
+        db.session.add(ShareSlice(
+            time=datetime.datetime.utcfromtimestamp(minute), value=3,
+            user="pool", worker="", algo="scrypt", span=0, share_type="acc"))
+        db.session.commit()
+
+        get_span = ShareSlice.get_span
+
+        def racing_get_span(*args, **kwargs):
+            res = get_span(*args, **kwargs)
+            append_share_history([dict(
+                time=datetime.datetime.utcfromtimestamp(minute + 60), value=2,
+                user="pool", worker="", algo="scrypt", share_type="acc")])
+            return res
+        ShareSlice.get_span = staticmethod(racing_get_span)
+        try:
+            share_history(user=["pool"])
+        finally:
+            ShareSlice.get_span = get_span
+
+        res = share_history(user=["pool"])
+        self.assertEqual(res[0]['values'], {minute: 3, minute + 60: 2})
+
+    def test_share_history_evicted_during_update(self):
+        """ An update that races an eviction doesn't bring the evicted
+        user's history back """
+        self.app.redis.zadd(SHARE_HISTORY_LRU, pool=time.time())
+        self.app.redis.hset(SHARE_HISTORY_SIZE, "pool", 0)
+
+        def evict(user, series):
+            self.app.redis.zrem(SHARE_HISTORY_LRU, user)
+            self.app.redis.hdel(SHARE_HISTORY_SIZE, user)
+            series['key'] = (array.array('I', [1]), array.array('d', [1]))
+            return series
+
+        self.assertEqual(_update_share_history(["pool"], evict), {})
+        self.assertFalse(self.app.redis.exists(SHARE_HISTORY_KEY.format("pool")))
+        self.assertEqual(self.app.redis.hgetall(SHARE_HISTORY_SIZE), {})
+
+    def test_share_history_not_cached(self):
+        """ Only valid addresses that have history get cached """
+        self.assertEqual(share_history(user=["garbage", "pool"]), [])
+        self.assertEqual(self.app.redis.zrange(SHARE_HISTORY_LRU, 0, -1), [])
+        self.assertEqual(self.app.redis.hgetall(SHARE_HISTORY_SIZE), {})
+
+    def test_share_history_update_races(self):
+        """ An update that keeps racing other writes gives up and drops the
+        user, rather than retrying forever """
+        self.app.redis.zadd(SHARE_HISTORY_LRU, pool=time.time())
+        self.app.redis.hset(SHARE_HISTORY_SIZE, "pool", 0)
+        calls = []
+
+        def race(user, series):
+            calls.append(user)
+            self.app.redis.hincrby(SHARE_HISTORY_SIZE, "other", 1)
+            return series
+
+        self.assertEqual(_update_share_history(["pool"], race), {})
+        self.assertEqual(len(calls), SHARE_HISTORY_RETRIES)
+        self.assertEqual(self.app.redis.zrange(SHARE_HISTORY_LRU, 0, -1), [])
+        self.assertEqual(self.app.redis.hgetall(SHARE_HISTORY_SIZE),
+                         {"other": str(SHARE_HISTORY_RETRIES)})
+
     def test_collect_ppagent(self, **kwargs):
         self.app.redis.hmset("hashrate_1409899740", dict(test__0="None", test__1="12.5"))
 
@@ -37,3 +193,18 @@ class TestCollectMinutes(RedisUnitTest):
         sl = DeviceSlice.query.all()
         assert sl[0].user == "test"
         assert sl[0].value == 12.5 * 1000000
+
+    def test_collect_ppagent_average(self):
+        """ Data points for a device that already has a slice are averaged
+        in rather than dropped """
+        self.app.redis.hmset("hashrate_1409899740", dict(test__1="12.5"))
+        collect_ppagent_data()
+        self.app.redis.hmset("hashrate_1409899740",
+                             dict(test__1="7.5", test__2="bogus", test__x="1"))
+        collect_ppagent_data()
+
+        db.session.rollback()
+        db.session.expunge_all()
+        sl = DeviceSlice.query.one()
+        self.assertEqual(sl.device, 1)
+        self.assertEqual(sl.value, 10 * 1000000)
@@ -1,6 +1,14 @@
-from simplecoin import currencies, chains
-from simplecoin.exceptions import InvalidAddressException
-from simplecoin.tests import UnitTest
+import bz2
+import random
+import requests
+import simplejson as json
+
+from decimal import Decimal
+
+from simplecoin import currencies, chains, powerpools
+from simplecoin.exceptions import InvalidAddressException, RemoteException
+from simplecoin.tests import UnitTest, RedisUnitTest
+from simplecoin.utils import encode_entries
 
 
 class TestConfig(UnitTest):
@@ -25,3 +33,235 @@ class TestConfig(UnitTest):
 
     def test_chain_repr(self):
         repr(chains.values()[0])
+
+    def test_powerpool_circuit_breaker(self):
+        powerpool = powerpools[1]
+        calls = []
+
+        def request(method, url, **kwargs):
+            calls.append(url)
+            if len(calls) <= powerpool.failure_limit:
+                raise RemoteException("down")
+            return {"ok": True}
+        powerpool._request = request
+
+        for i in xrange(powerpool.failure_limit + 2):
+            self.assertRaises(RemoteException, powerpool.request, '')
+        self.assertEqual(len(calls), powerpool.failure_limit)
+
+        # Once retry_after passes a single probe goes through at a time
+        probes = []
+
+        def probe(method, url, **kwargs):
+            probes.append(url)
+            self.assertRaises(RemoteException, powerpool.request, '')
+            return {"ok": True}
+        powerpool._request = probe
+        powerpool._retry_at = 0
+        self.assertEqual(powerpool.request(''), {"ok": True})
+        self.assertEqual(len(probes), 1)
+
+        powerpool._request = request
+        powerpool._failures = powerpool.failure_limit
+        powerpool._retry_at = 0
+        self.assertEqual(powerpools.request_all(''),
+                         {powerpool: ({"ok": True}, None)})
+        self.assertEqual(powerpool._failures, 0)
+
+    def test_powerpool_stream_closed(self):
+        """ Streamed responses are closed, and handler errors raised as
+        RemoteException """
+        closed = []
+
+        class Response(object):
+            status_code = 200
+
+            def close(self):
+                closed.append(True)
+
+        class Session(object):
+            def request(self, method, url, **kwargs):
+                return Response()
+
+        def handler(response):
+            raise KeyError('worker')
+
+        powerpool = powerpools[1]
+        powerpool._session = Session()
+        self.assertRaises(RemoteException, powerpool._request, 'GET',
+                          'clients/', handler=handler)
+        self.assertEqual(closed, [True])
+
+    def test_coinserv_batch_timeout(self):
+        """ Batch requests give up on a coinserver after the given timeout """
+        sent = []
+
+        def post(url, **kwargs):
+            sent.append(kwargs['timeout'])
+            raise requests.Timeout("timed out")
+        post_orig = requests.post
+        requests.post = post
+        try:
+            self.assertRaises(RemoteException, currencies['DOGE'].coinserv_batch,
+                              [("getblockcount", [])], timeout=3)
+        finally:
+            requests.post = post_orig
+        self.assertEqual(sent, [3])
+
+
+class TestChainShares(RedisUnitTest):
+    def test_calc_shares_batched(self):
+        """ Make sure slices spread over several fetch batches and encodings
+        are all aggregated, and that we stop once the target is reached """
+        chain = chains[1]
+        chain.slice_batch_size = 3
+        for i in xrange(1, 11):
+            if i % 2:
+                self.app.redis.rpush("chain_1_slice_{}".format(i),
+                                     "DJCgMCyjBKxok3eEGed5SGhbWaGj5QTcxF:2")
+            else:
+                data = bz2.compress(json.dumps(
+                    [["DLePZigvzzvSyoWztctVVsPtDuhzBfqEgd", Decimal("3")]],
+                    use_decimal=True))
+                self.app.redis.hmset("chain_1_slice_{}".format(i),
+                                     dict(encoding="bz2json", data=data,
+                                          total_shares=3))
+
+        users = chain._calc_shares(10, stop_slice=0)
+        self.assertEqual(users["DJCgMCyjBKxok3eEGed5SGhbWaGj5QTcxF"], 10)
+        self.assertEqual(users["DLePZigvzzvSyoWztctVVsPtDuhzBfqEgd"], 15)
+
+        users = chain._calc_shares(10, target_shares=8)
+        self.assertEqual(sum(users.itervalues()), 8)
+
+    def test_accumulator(self):
+        """ Payouts computed through the share accumulator should exactly
+        match a full scan of the slices """
+        chain = chains[1]
+        chain.slice_batch_size = 4
+        chain.accumulator_interval = 7
+        addresses = ['DSAEhYmKZmDN9e1vGPRWSvRQEiWGARhiVh',
+                     'DLePZigvzzvSyoWztctVVsPtDuhzBfqEgd',
+                     'DKcNvReNSfaCV9iCJjBnxt8zJfiTqzv2vk']
+        for i in xrange(1, 61):
+            entries = [(random.choice(addresses),
+                        Decimal(random.randint(1, 20)) / 4)
+                       for _ in xrange(random.randint(i > 55, 5))]
+            key = "chain_1_slice_{}".format(i)
+            if i > 55:
+                if entries:
+                    self.app.redis.rpush(key, *["{}:{}".format(*e)
+                                                for e in entries])
+            elif entries:
+                data = bz2.compress(json.dumps(entries, use_decimal=True))
+                self.app.redis.hmset(key, dict(encoding="bz2json", data=data,
+                                               total_shares=0))
+        self.app.redis.set("chain_1_slice_index", 60)
+
+        def compare():
+            results = []
+            for kwargs in [dict(stop_slice=0), dict(stop_slice=23),
+                           dict(target_shares=10), dict(target_shares=97.5),
+                           dict(target_shares=100000)]:
+                for start in (60, 52, 30):
+                    results.append(chain._calc_shares(start, **kwargs))
+            return results
+
+        expected = compare()
+        self.assertEqual(chain.update_accumulator(), 55)
+        self.assertEqual(self.app.redis.get("chain_1_acc_head"), "55")
+        self.assertEqual(compare(), expected)
+
+        chain.trim_accumulator(18)
+        self.assertEqual(self.app.redis.get("chain_1_acc_floor"), "18")
+        for i in xrange(1, 19):
+            self.app.redis.delete("chain_1_slice_{}".format(i))
+        chain.reset_accumulator()
+        expected = compare()
+        chain.update_accumulator()
+        chain.trim_accumulator(18)
+        self.assertEqual(compare(), expected)
+
+    def test_accumulator_late_slice(self):
+        """ A slice that shows up after the accumulator ran should still be
+        counted, and checkpoints the payouts can't reach get removed """
+        chain = chains[1]
+        chain.accumulator_interval = 5
+
+        def write(index, entries):
+            data = bz2.compress(json.dumps(entries, use_decimal=True))
+            self.app.redis.hmset("chain_1_slice_{}".format(index),
+                                 dict(encoding="bz2json", data=data,
+                                      total_shares=0))
+
+        address = 'DSAEhYmKZmDN9e1vGPRWSvRQEiWGARhiVh'
+        for i in xrange(1, 9):
+            write(i, [(address, Decimal(1))])
+        self.app.redis.set("chain_1_slice_index", 10)
+        self.assertEqual(chain.update_accumulator(), 8)
+        self.assertEqual(self.app.redis.get("chain_1_acc_head"), "8")
+
+        # Slice 9 was empty, but 10 was only written to afterwards
+        write(10, [(address, Decimal(4))])
+        self.assertEqual(chain.update_accumulator(), 2)
+        self.assertEqual(self.app.redis.get("chain_1_acc_head"), "10")
+        self.assertEqual(chain._calc_shares(10, stop_slice=0), {address: 12})
+
+        # Moving the slice index along moves the floor up behind it
+        chain.max_indexes = 6
+        write(11, [(address, Decimal(1))])
+        self.app.redis.set("chain_1_slice_index", 12)
+        self.assertEqual(chain.update_accumulator(), 1)
+        self.assertEqual(self.app.redis.get("chain_1_acc_floor"), "6")
+        self.assertFalse(self.app.redis.exists("chain_1_acc_prefix_0"))
+        self.assertFalse(self.app.redis.exists("chain_1_acc_prefix_5"))
+        self.assertTrue(self.app.redis.exists("chain_1_acc_prefix_10"))
+        self.assertEqual(chain._calc_shares(11, stop_slice=0), {address: 8})
+
+    def test_packed_encoding(self):
+        """ Packed slices should decode to exactly the entries they were
+        made from, in the same order """
+        chain = chains[1]
+        entries = [("DSAEhYmKZmDN9e1vGPRWSvRQEiWGARhiVh", Decimal("512")),
+                   (u"DLePZigvzzvSyoWztctVVsPtDuhzBfqEgd", Decimal("0.125")),
+                   ("DSAEhYmKZmDN9e1vGPRWSvRQEiWGARhiVh", Decimal("1E+3"))]
+        data, encoding = chain.encode_slice(entries, "packed")
+        self.assertEqual(encoding, "packed")
+        decoded = chain.decode_slice(dict(encoding=encoding, data=data))
+        self.assertEqual(decoded, entries)
+        for _, shares in decoded:
+            assert isinstance(shares, Decimal)
+
+        # Values that can't be stored exactly fall back to bz2json
+        data, encoding = chain.encode_slice(
+            [("test", Decimal("1E-20"))], "packed")
+        self.assertEqual(encoding, "bz2json")
+        _, encoding, error = encode_entries(
+            [("test", Decimal("1E-20"))], "packed")
+        self.assertEqual(encoding, "bz2json")
+        self.assertIsInstance(error, ValueError)
+
+    def test_interned_encoding(self):
+        """ Interned slices refer to users by a chain wide id """
+        chain = chains[1]
+        entries = [("DSAEhYmKZmDN9e1vGPRWSvRQEiWGARhiVh", Decimal("512")),
+                   ("DLePZigvzzvSyoWztctVVsPtDuhzBfqEgd", Decimal("2.5")),
+                   ("DSAEhYmKZmDN9e1vGPRWSvRQEiWGARhiVh", Decimal("256"))]
+        data, encoding = chain.encode_slice(entries, "interned")
+        self.assertEqual(encoding, "interned")
+        self.assertEqual(chain.decode_slice(dict(encoding=encoding, data=data)),
+                         entries)
+
+        # Ids are stable and only assigned once
+        ids = chain.intern_users(["DLePZigvzzvSyoWztctVVsPtDuhzBfqEgd",
+                                  "DKcNvReNSfaCV9iCJjBnxt8zJfiTqzv2vk"])
+        self.assertEqual(len(set(ids.values())), 2)
+        self.assertEqual(ids, chain.intern_users(ids.keys()))
+        self.assertEqual(self.app.redis.get("chain_1_user_count"), "3")
+
+        # A fresh process has to resolve the ids from redis
+        chain._user_names.clear()
+        self.app.redis.hmset("chain_1_slice_1", dict(encoding=encoding,
+                                                     data=data))
+        users = chain._calc_shares(1, stop_slice=0)
+        self.assertEqual(users["DSAEhYmKZmDN9e1vGPRWSvRQEiWGARhiVh"], 768)
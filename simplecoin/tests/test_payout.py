@@ -4,7 +4,7 @@ import unittest
 import random
 
 from simplecoin import db, currencies
-from simplecoin.scheduler import _distributor
+from simplecoin.scheduler import _distributor, _int_distributor
 from simplecoin.tests import RedisUnitTest, UnitTest
 import simplecoin.models as m
 from simplecoin.scheduler import (credit_block, create_payouts,
@@ -71,6 +71,33 @@ class TestDistributor(unittest.TestCase):
         splits = {}
 
         self.assertRaises(Exception, _distributor, (amount, splits))
+        self.assertRaises(Exception, _int_distributor, (amount, splits))
+
+    def test_int_engine(self):
+        """ The integer engine gives exactly the same splits as the Decimal
+        one """
+        cases = [
+            (Decimal("100"), {"a": Decimal(100), "b": Decimal(256), "c": Decimal(3)}),
+            (Decimal("0.7109375"), {0: Decimal('0.9000000000000000000000000000'),
+                                    1: Decimal('0.1000000000000000000000000000')}),
+            (Decimal("1.0117691900000000000000000000"),
+             {"a": Decimal('0.0976562500000000000000000000'),
+              "b": Decimal('8.3125'),
+              "c": Decimal('0.8789062500000000000000000000'),
+              "d": Decimal('0.71484375')}),
+            (Decimal("1.00007884"), {"test": Decimal('0.32187500'),
+                                     "two": Decimal('2.89687500'),
+                                     "other": Decimal('2.78515625')}),
+            (Decimal("25"), {i: 1 for i in xrange(7)}),
+            (Decimal("25.00000001"),
+             {str(i): Decimal(random.randint(1, 2 ** 20)) / 8 for i in xrange(1000)}),
+        ]
+        for amount, splits in cases:
+            expected = _distributor(amount, splits.copy())
+            result = _int_distributor(amount, splits.copy())
+            self.assertEqual(expected.keys(), result.keys())
+            self.assertEqual(map(str, expected.values()),
+                             map(str, result.values()))
 
 
 class TestGenerateTradeRequests(UnitTest):
@@ -351,6 +378,12 @@ class TestPayouts(RedisUnitTest):
 
         assert m.Credit.query.filter_by(source=1).one().amount == Decimal("0.250")
 
+    def test_payout_multichain_sequential(self):
+        """ Calculating chain shares without the thread pool gives the same
+        credits """
+        self.app.config['share_calc_threads'] = 1
+        self.test_payout_multichain()
+
     def test_payout(self, **kwargs):
         """ A regular, basic payout to one chain, with one user """
         bd = self.test_block_data.copy()
@@ -1,7 +1,7 @@
 import datetime
 
 from simplecoin.tests import UnitTest
-from simplecoin.models import ShareSlice, make_upper_lower
+from simplecoin.models import ShareSlice, DeviceSlice, make_upper_lower
 
 
 class SliceTests(UnitTest):
@@ -25,6 +25,64 @@ class SliceTests(UnitTest):
         res = ShareSlice.get_span(stamp=True)
         self.assertEqual(sum(res[0]['values'].values()), 44850)
 
+    def test_span_grouped(self):
+        start = datetime.datetime.utcnow()
+        for x in xrange(300):
+            now = start - datetime.timedelta(minutes=x)
+            for worker in ("", "rig"):
+                v = ShareSlice(time=now, value=x, **dict(self.slice_test_data,
+                                                         worker=worker))
+                self.db.session.add(v)
+        self.db.session.commit()
+        lower, upper = make_upper_lower()
+
+        for kwargs in (dict(lower=lower, upper=upper), {}):
+            res = ShareSlice.get_span(stamp=True, **kwargs)
+            grouped = ShareSlice.get_span(stamp=True, grouped=True, **kwargs)
+            self.assertEqual(len(grouped), 2)
+            for old, new in zip(sorted(res, key=lambda r: r['data']['worker']),
+                                grouped):
+                self.assertEqual(old['data'], new['data'])
+                self.assertEqual(old['values'], new['values'])
+
+        res = ShareSlice.get_span(lower=lower, upper=upper)
+        grouped = ShareSlice.get_span(lower=lower, upper=upper, grouped=True)
+        self.assertEqual(
+            sorted(res, key=lambda r: r['data']['worker'])[0]['values'],
+            grouped[0]['values'])
+
+    def test_bulk_upsert_many_keys(self):
+        """ Existing rows are still merged when a key column has more values
+        than fit in one IN list """
+        now = datetime.datetime(2014, 1, 1)
+        rows = [dict(self.slice_test_data, user="user{}".format(i), time=now,
+                     value=1) for i in xrange(250)]
+        ShareSlice.bulk_upsert(rows)
+        self.db.session.commit()
+        ShareSlice.bulk_upsert(rows)
+        self.db.session.commit()
+
+        self.assertEqual(ShareSlice.query.count(), 250)
+        self.assertEqual(set(s.value for s in ShareSlice.query), set([2]))
+
+    def test_span_grouped_device(self):
+        """ Grouped device series are the plain average of each bucket. The
+        pairwise combine used before weighted the newest samples the most
+        and halved the first one, giving 13.5625 here """
+        start = DeviceSlice.floor_time(
+            datetime.datetime.utcnow() - datetime.timedelta(minutes=30), 1)
+        data = dict(user="test", worker="", device=0, stat_val=0)
+        for x, value in enumerate((2, 4, 6, 10, 20)):
+            self.db.session.add(DeviceSlice(
+                time=start + datetime.timedelta(minutes=x), value=value,
+                span=0, **data))
+        self.db.session.commit()
+
+        res = DeviceSlice.get_span(stamp=True, grouped=True, slice_size=1,
+                                   user=["test"])
+        stamp = DeviceSlice.floor_time(start, 1, stamp=True)
+        self.assertEqual(res[0]['values'], {stamp: 8.4})
+
     def test_compress(self):
         start = datetime.datetime.utcnow().replace(second=0, microsecond=0)
         for x in xrange(1500):
@@ -64,3 +122,35 @@ class SliceTests(UnitTest):
 
         res = ShareSlice.get_span(stamp=True)
         self.assertEqual(sum(res[0]['values'].values()), 1124250)
+
+    def test_compress_device(self):
+        """ Device slices get averaged when compressed, including into an
+        upper slice that already exists """
+        start = DeviceSlice.floor_time(
+            datetime.datetime.utcnow() - datetime.timedelta(hours=3), 1)
+        data = dict(user="test", worker="", device=0, stat_val=0)
+        for x in xrange(5):
+            now = start + datetime.timedelta(minutes=x)
+            self.db.session.add(DeviceSlice(time=now, value=x, span=0, **data))
+        self.db.session.add(DeviceSlice(
+            time=start - datetime.timedelta(minutes=4), value=5, span=0, **data))
+        self.db.session.add(DeviceSlice(
+            time=start - datetime.timedelta(minutes=5), value=3, span=1, **data))
+        self.db.session.commit()
+
+        DeviceSlice.compress(0)
+        self.db.session.commit()
+
+        slcs = DeviceSlice.query.order_by(DeviceSlice.time).all()
+        self.assertEqual([(s.span, s.value) for s in slcs],
+                         [(1, 4), (1, 2)])
+
+    def test_partition_bounds(self):
+        dt = datetime.datetime(2014, 12, 31, 23, 59)
+        self.assertEqual(ShareSlice._partition_bounds(1, dt),
+                         (datetime.datetime(2014, 12, 31),
+                          datetime.datetime(2015, 1, 1)))
+        self.assertEqual(ShareSlice._partition_bounds(2, dt),
+                         (datetime.datetime(2014, 12, 1),
+                          datetime.datetime(2015, 1, 1)))
+        assert not ShareSlice.partitioned()
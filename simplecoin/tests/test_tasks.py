@@ -1,8 +1,22 @@
-from simplecoin import cache, chains
-from simplecoin.scheduler import chain_cleanup
+from simplecoin import cache, chains, currencies, db, powerpools
+from simplecoin.models import (Block, Credit, CreditExchange, Payout,
+                               Transaction)
+from simplecoin.utils import get_online_workers, online_shard, ONLINE_SHARDS
+from simplecoin.scheduler import (chain_cleanup, credit_cleanup, update_network,
+                                  update_block_state, poll_monitors,
+                                  _count_clients, compress_slices, _rpc_fanout,
+                                  _unlink_keys, _cache_set_many)
+from simplecoin.exceptions import RemoteException
 from simplecoin.tests import RedisUnitTest
 
+import datetime
+import json
 import random
+import requests
+import time
+
+from decimal import Decimal
+from redis import ResponseError
 
 
 class TestTasks(RedisUnitTest):
@@ -25,6 +39,287 @@ class TestTasks(RedisUnitTest):
         cache.set("DOGE_data", dict(difficulty_avg=diff_for_shares,
                                     difficulty_avg_stale=False, timeout=1200))
 
-        chain_cleanup(chains[1], dont_simulate=True)
-        # 11 total keys, we will delete 5
+        stats = chain_cleanup(chains[1], dont_simulate=True)
+        # 10 slices plus the slice index, the 3 oldest slices get deleted
         self.assertEquals(len(self.app.redis.keys("chain_1_slice_*")), 8)
+        self.assertEquals(stats['keys'], 3)
+        # Sizes are best effort, but DEBUG OBJECT works here so they count
+        self.assertGreater(stats['bytes'], 0)
+
+    def test_unlink_keys_unsized(self):
+        """ Keys are still removed when their sizes can't be read """
+        def debug_object(key):
+            raise ResponseError("ERR DEBUG command not allowed")
+        self.app.redis.debug_object = debug_object
+        for i in xrange(5):
+            self.app.redis.rpush("chain_1_slice_{}".format(i), "a:1")
+
+        keys = ["chain_1_slice_{}".format(i) for i in xrange(6)]
+        self.assertEqual(_unlink_keys(keys, 2), (5, 0))
+        self.assertEqual(self.app.redis.keys("chain_1_slice_*"), [])
+
+    def test_slice_registry(self):
+        """ Compression and cleanup work from the slice registry rather than
+        walking every index """
+        chain = chains[1]
+        for i in xrange(5):
+            self.app.redis.rpush("chain_1_slice_{}".format(i), "a:2", "b:1")
+        self.app.redis.set("chain_1_slice_index", 4)
+
+        compress_slices()
+        self.assertEqual(list(chain.registered_slices(4)),
+                         [(i, "compressed", 3.0) for i in xrange(4, -1, -1)])
+        self.assertEqual(chain.register_slices(4), [])
+
+        # Only slices above the highest registered one are searched for
+        self.app.redis.rpush("chain_1_slice_6", "a:1")
+        self.assertEqual(chain.register_slices(6), [6])
+        self.assertEqual(list(chain.registered_slices(6, 5)),
+                         [(6, "raw", 0.0)])
+
+        # So one written below that has to be swept up
+        self.app.redis.rpush("chain_1_slice_5", "a:1")
+        self.assertEqual(chain.register_slices(6), [6])
+        self.assertEqual(chain.sweep_slices(), [5])
+        self.assertEqual(chain.register_slices(6), [6, 5])
+        self.assertEqual(chain.sweep_slices(), [])
+
+        chain.unregister_slices(6)
+        self.assertEqual(list(chain.registered_slices(6)), [])
+
+    def test_compress_slices_pool(self):
+        """ Slices encoded by the thread pool decode to the same shares """
+        chain = chains[1]
+        chain.slice_batch_size = 5
+        self.app.config['slice_compress_threads'] = 2
+        for i in xrange(12):
+            self.app.redis.rpush("chain_1_slice_{}".format(i),
+                                 "a:{}".format(i + 1), "b:1", "c:0.5")
+        self.app.redis.set("chain_1_slice_index", 11)
+
+        stats = compress_slices()
+        self.assertEqual(stats['slices'], 12)
+        self.assertEqual(stats['entries'], 36)
+        for i in xrange(12):
+            slc = self.app.redis.hgetall("chain_1_slice_{}".format(i))
+            self.assertEqual(slc['encoding'], "interned")
+            self.assertEqual(chain.decode_slice(slc),
+                             [("a", Decimal(i + 1)), ("b", Decimal(1)),
+                              ("c", Decimal("0.5"))])
+
+    def test_credit_cleanup(self):
+        """ Only credits paid out in a sent transaction for old blocks are
+        deleted, across batches and both credit tables """
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+        old_blk = self.make_block(currency="DOGE", found_at=old, hash="old")
+        new_blk = self.make_block(currency="DOGE", hash="new")
+        tx = Transaction(txid="tx", currency="DOGE")
+        sent = Payout(transaction=tx, address="DOGE", currency="DOGE",
+                      amount="1")
+        pending = Payout(address="DOGE", currency="DOGE", amount="1")
+        for i in xrange(3):
+            db.session.add(Credit(block=old_blk, payout=sent, amount="1",
+                                  currency="DOGE", address="DOGE"))
+            db.session.add(CreditExchange(block=old_blk, payout=sent,
+                                          amount="1", currency="DOGE",
+                                          address="DOGE"))
+        kept = [Credit(block=new_blk, payout=sent, amount="1",
+                       currency="DOGE", address="new"),
+                CreditExchange(block=old_blk, payout=pending, amount="1",
+                               currency="DOGE", address="pending"),
+                Credit(block=old_blk, amount="1", currency="DOGE",
+                       address="unpaid")]
+        db.session.add_all(kept)
+        db.session.commit()
+        kept = sorted(credit.id for credit in kept)
+
+        credit_cleanup(dont_simulate=False)
+        self.assertEqual(Credit.query.count(), 9)
+
+        stats = credit_cleanup(batch_size=4, sleep=0, dont_simulate=True)
+        self.assertEqual(stats['credits'], 6)
+        self.assertEqual(stats['exchange_credits'], 3)
+        db.session.expire_all()
+        self.assertEqual(sorted(c.id for c in Credit.query), kept)
+        self.assertEqual(CreditExchange.query.count(), 1)
+
+    def test_update_network_timeout(self):
+        """ A hung coinserver doesn't hold up the others """
+        class Coinserv(object):
+            def __init__(self, delay):
+                self.delay = delay
+
+            def getblocktemplate(self, params):
+                time.sleep(self.delay)
+                return dict(height=100, bits="1b0404cb",
+                            coinbasevalue=5000000000)
+
+        self.app.config['network_rpc_timeout'] = 0.5
+        currencies['DOGE'].coinserv = Coinserv(0)
+        currencies['TCO'].coinserv = Coinserv(1.5)
+
+        # The hung call is waited out, but isn't used
+        t = time.time()
+        update_network()
+        self.assertLess(time.time() - t, 2.5)
+
+        self.assertEqual(cache.get("DOGE_data")['height'], 100)
+        self.assertIsNone(cache.get("TCO_data"))
+        doge = cache.cache._client.hgetall("DOGE_rpc_stats")
+        tco = cache.cache._client.hgetall("TCO_rpc_stats")
+        self.assertEqual(doge['calls'], "1")
+        self.assertNotIn('errors', doge)
+        self.assertEqual(tco['errors'], "1")
+        self.assertIn("TimeoutError", tco['last_error'])
+
+    def test_rpc_fanout_queued(self):
+        """ Calls waiting for a thread get their full timeout once they
+        start, and calls that never start aren't counted as errors """
+        self.app.config['network_rpc_threads'] = 1
+        self.app.config['network_rpc_timeout'] = 0.5
+        doge, tco = currencies['DOGE'], currencies['TCO']
+
+        def call(delay):
+            return lambda: time.sleep(delay) or delay
+
+        res = list(_rpc_fanout([(doge, call(0.3)), (tco, call(0.3))]))
+        self.assertEqual(res, [(doge, 0.3, None), (tco, 0.3, None)])
+
+        ran = []
+        res = list(_rpc_fanout([(doge, call(1)), (tco, lambda: ran.append(True))]))
+        self.assertEqual([(c, r) for c, r, _ in res], [(doge, None), (tco, None)])
+        self.assertIn("Never started", str(res[1][2]))
+        # Calls that never started don't run once the fan-out is over
+        time.sleep(0.2)
+        self.assertEqual(ran, [])
+        tco_stats = cache.cache._client.hgetall("TCO_rpc_stats")
+        self.assertEqual(tco_stats['calls'], "1")
+        self.assertNotIn('errors', tco_stats)
+
+    def test_update_block_state(self):
+        """ Blocks are checked in one batch and their credits updated """
+        doge = currencies['DOGE']
+        confirms = doge.block_mature_confirms
+        blocks = {}
+        for name, height in [("mature", 100), ("short", 101), ("gone", 102),
+                             ("young", 1000)]:
+            blocks[name] = self.make_block(currency="DOGE", height=height,
+                                           hash=name)
+            db.session.add(Credit(block=blocks[name], amount="1", type=0,
+                                  currency="DOGE", address="DOGE"))
+        db.session.commit()
+
+        # Only the HTTP transport is faked, so the batch goes through
+        # coinserv_batch on the fan-out's threads
+        batches = []
+        outputs = dict(mature=dict(result=dict(confirmations=confirms)),
+                       short=dict(result=dict(confirmations=confirms - 1)),
+                       gone=dict(result=None, error="Block not found"))
+
+        class Response(object):
+            def __init__(self, payload):
+                self.payload = payload
+
+            def json(self):
+                return [dict(outputs[call['params'][0]], id=call['id'])
+                        for call in self.payload]
+
+        def post(url, data=None, **kwargs):
+            batches.append(json.loads(data))
+            return Response(batches[-1])
+
+        doge.coinserv.getblockcount = lambda: 1000
+        post_orig = requests.post
+        requests.post = post
+        try:
+            update_block_state()
+        finally:
+            requests.post = post_orig
+
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 3)
+        db.session.expire_all()
+        states = {name: (blk.mature, blk.orphan, blk.credits[0].payable)
+                  for name, blk in blocks.iteritems()}
+        self.assertEqual(states, dict(mature=(True, False, True),
+                                      short=(False, True, False),
+                                      gone=(False, True, False),
+                                      young=(False, False, False)))
+
+    def test_poll_monitors(self):
+        """ One poll fills both the online workers and server status """
+        views = {
+            'clients/': {'clients': {'DAddr': [{'worker': 'rig1'},
+                                               {'worker': 'rig1'}]}},
+            '': {'client_count_authed': 2, 'address_count': 1, 'hps': 1000,
+                 'last_flush_job': {'currency': 'DOGE'}}}
+
+        class Response(object):
+            def __init__(self, data):
+                self.data = json.dumps(data)
+
+            def iter_content(self, size):
+                for i in xrange(0, len(self.data), 7):
+                    yield self.data[i:i + 7]
+
+        def request(method, url, handler=None):
+            data = views[url.split('/', 4)[-1]]
+            return handler(Response(data)) if handler else data
+        powerpools[1]._request = request
+
+        poll_monitors()
+
+        self.assertEqual(get_online_workers('DAddr'), {'rig1': {1: 2}})
+        self.assertEqual(cache.get('server_status')[1]['workers'], 2)
+        self.assertEqual(cache.get('server_status')[1]['currently_mining'], 'DOGE')
+        self.assertEqual(cache.get('total_miners'), {'scrypt': 1})
+        self.assertEqual(cache.get('hashrate_DOGE'), 1000)
+        self.assertEqual(cache.get('hashrate_TCO'), 0)
+
+        # Addresses that have gone offline are dropped on the next poll
+        views['clients/'] = {'clients': {'LAddr': [{'worker': ''}]}}
+        poll_monitors()
+        self.assertEqual(get_online_workers('DAddr'), {})
+        self.assertEqual(get_online_workers('LAddr'), {'': {1: 1}})
+        self.assertEqual(cache.cache._client.smembers(ONLINE_SHARDS),
+                         set([online_shard('LAddr')]))
+
+        # A monitor that can't be reached doesn't take its workers with it
+        def down(method, url, handler=None):
+            raise RemoteException("down")
+        powerpools[1]._request = down
+        poll_monitors()
+        self.assertEqual(get_online_workers('LAddr'), {'': {1: 1}})
+
+    def test_online_workers_failed_monitor(self):
+        """ Workers an address has on a monitor that couldn't be polled are
+        kept, even when the address is also reported by another monitor """
+        _cache_set_many([], online={'DAddr': {'rig1': {1: 2, 2: 1},
+                                              'rig2': {2: 1},
+                                              'rig3': {1: 1}}})
+
+        _cache_set_many([], online={'DAddr': {'rig1': {1: 3}}},
+                        failed=set([2]))
+        self.assertEqual(get_online_workers('DAddr'),
+                         {'rig1': {1: 3, 2: 1}, 'rig2': {2: 1}})
+
+        # Once both monitors report again the old connections go away
+        _cache_set_many([], online={'DAddr': {'rig1': {1: 3}}})
+        self.assertEqual(get_online_workers('DAddr'), {'rig1': {1: 3}})
+
+    def test_count_clients(self):
+        """ Connections are counted from the streamed clients/ view whether
+        they come as a list or a dictionary """
+        data = ('{"version": 1.25, "clients": {"DAddr": [{"worker": "a"}, '
+                '"bad", {"worker": "a"}, {"worker": "b"}], "LAddr": {"1": '
+                '{"worker": "", "diff": 1024}}, "empty": []}, "count": 123}')
+        for size in (1, 5, 1000):
+            chunks = [data[i:i + size] for i in xrange(0, len(data), size)]
+
+            class Response(object):
+                def iter_content(self, chunk_size):
+                    return iter(chunks)
+
+            self.assertEqual(_count_clients(Response()),
+                             {"DAddr": {"a": 2, "b": 1}, "LAddr": {"": 1},
+                              "empty": {}})
@@ -51,3 +51,12 @@ class TestViews(UnitTest):
         db.session.add(s)
         db.session.commit()
         assert "185cYTmEaTtKmBZc8aSGCr9v2VCDLqQHgR" in anon_users()
+
+    def test_crontabs(self):
+        leaderboard()
+        # An expired task is dropped from the listing
+        cache.cache._client.sadd("cron_tasks", "expired")
+        rv = self.client.get('/crontabs')
+        self.assertEqual(rv.status_code, 200)
+        assert "<td>leaderboard</td>" in rv.data
+        assert "<td>expired</td>" not in rv.data
@@ -1,17 +1,27 @@
+import array
+import bz2
+import bisect
+import calendar
 import datetime
 import time
 import yaml
 import json
+import re
+import simplejson
+import struct
+import zlib
 
+from collections import OrderedDict
 from flask import current_app, session
 from sqlalchemy.exc import SQLAlchemyError
+from redis import WatchError
 from cryptokit.rpc import CoinRPCException
 from decimal import Decimal as dec, Decimal
 
 from .exceptions import CommandException, InvalidAddressException
 from . import db, cache, root, redis_conn, currencies, powerpools, algos, chains
 from .models import (ShareSlice, Block, Credit, UserSettings, make_upper_lower,
-                     Payout, CreditExchange)
+                     Payout, CreditExchange, PoolShareSlice)
 
 
 class ShareTracker(object):
@@ -124,6 +134,20 @@ def get_past_chain_profit():
     return past_chain_profit
 
 
+@cache.memoize(timeout=600)
+def pool_rollup_ready():
+    """ Whether PoolShareSlice goes back as far as the pool's share slices.
+    Until `manage.py rebuild_pool_slices` backfills it, the rollup only has
+    what has been collected since it was added, so pool totals are read from
+    ShareSlice instead. """
+    rollup = db.session.query(db.func.min(PoolShareSlice.time)).scalar()
+    if rollup is None:
+        return False
+    oldest = (db.session.query(db.func.min(ShareSlice.time)).
+              filter(ShareSlice.user.in_(("pool", "pool_currency"))).scalar())
+    return oldest is None or rollup <= oldest
+
+
 @cache.memoize(timeout=3600)
 def pool_share_tracker(algo, timedelta=None, user=None, worker=None):
     """ Get accepted and rejected share count totals for the last month """
@@ -132,8 +156,20 @@ def pool_share_tracker(algo, timedelta=None, user=None, worker=None):
 
     lower, upper = make_upper_lower(span=timedelta)
     tracker = ShareTracker(algo)
-    for slc in ShareSlice.get_span(ret_query=True, upper=upper, lower=lower,
-                                   user=user, algo=(algo, ), worker=worker):
+    # Pool wide totals can come from the much smaller rollup table
+    rollup = pool_rollup_ready()
+    if rollup and user == ("pool", ):
+        query = PoolShareSlice.get_span(ret_query=True, upper=upper,
+                                        lower=lower, algo=(algo, ),
+                                        currency=("", ))
+    elif rollup and user == ("pool_currency", ):
+        query = PoolShareSlice.get_span(ret_query=True, upper=upper,
+                                        lower=lower, algo=(algo, ),
+                                        currency=worker)
+    else:
+        query = ShareSlice.get_span(ret_query=True, upper=upper, lower=lower,
+                                    user=user, algo=(algo, ), worker=worker)
+    for slc in query:
         tracker.count_slice(slc)
     return tracker
 
@@ -164,8 +200,15 @@ def anon_users():
 def get_pool_hashrate(algo):
     """ Retrieves the pools hashrate average for the last 10 minutes. """
     lower, upper = make_upper_lower(offset=datetime.timedelta(minutes=2))
-    ten_min = (ShareSlice.query.filter_by(user='pool', algo=algo, share_type="acc")
-               .filter(ShareSlice.time >= lower, ShareSlice.time <= upper))
+    if pool_rollup_ready():
+        ten_min = (PoolShareSlice.query.filter_by(algo=algo, currency="",
+                                                  share_type="acc")
+                   .filter(PoolShareSlice.time >= lower,
+                           PoolShareSlice.time <= upper))
+    else:
+        ten_min = (ShareSlice.query.filter_by(user='pool', algo=algo,
+                                              share_type="acc")
+                   .filter(ShareSlice.time >= lower, ShareSlice.time <= upper))
     ten_min = sum([min.value for min in ten_min])
     # shares times hashes per n1 share divided by 600 seconds and 1000 to get
     # khash per second
@@ -352,7 +395,7 @@ def collect_user_stats(user_address):
     hide_hr = newest < datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config['worker_hashrate_fold'])
 
     # pull online status from cached pull direct from powerpool servers
-    for worker_name, connection_summary in (cache.get('addr_online_' + user_address) or {}).iteritems():
+    for worker_name, connection_summary in get_online_workers(user_address).iteritems():
         for ppid, connections in connection_summary.iteritems():
             try:
                 powerpool = powerpools[ppid]
@@ -532,6 +575,500 @@ def time_format(seconds):
     return "{:,.4f} sec".format(seconds)
 
 
+# The names of the tasks that have cron_last_run_ entries
+CRON_TASKS = "cron_tasks"
+
+
+def scan_keys(pattern, conn=redis_conn):
+    """ Finds the keys matching a pattern with SCAN instead of KEYS, so Redis
+    isn't blocked while the whole keyspace is searched. SCAN may return a key
+    more than once, so the keys come back as a set. """
+    return set(conn.scan_iter(match=pattern, count=1000))
+
+
+# Which powerpools each address has workers connected to, in Redis hashes
+# sharded by address prefix. Each maps addresses to a JSON dictionary of
+# {worker: {powerpool id: connection count}}
+ONLINE_SHARD_KEY = "online_workers_{}"
+# The shards written by the last poll
+ONLINE_SHARDS = "online_workers_shards"
+
+
+def online_shard(address):
+    """ Addresses start with their version character, so shard on the two
+    after it """
+    return ONLINE_SHARD_KEY.format(address[1:3])
+
+
+def get_online_workers(address):
+    """ Returns an address' {worker: {powerpool id: connection count}} """
+    data = cache.cache._client.hget(online_shard(address), address)
+    if not data:
+        return {}
+    return {worker: {int(ppid): count for ppid, count in servers.iteritems()}
+            for worker, servers in json.loads(data).iteritems()}
+
+
+class JSONStream(object):
+    """
+    Incrementally parses a JSON document from an iterable of string chunks,
+    such as a streamed HTTP response. Objects and arrays can be walked one
+    member at a time with items and elements, and anything read with value
+    is decoded whole. Only the unread part of the document is buffered.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = ""
+        self._pos = 0
+        self._done = False
+
+    def _fill(self):
+        """ Drops what has been read and at least doubles what's left in the
+        buffer. Returns False at the end of the stream. """
+        parts = [self._buf[self._pos:]]
+        want = max(len(parts[0]), 1)
+        read = 0
+        while read < want and not self._done:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._done = True
+            else:
+                parts.append(chunk)
+                read += len(chunk)
+        self._buf = "".join(parts)
+        self._pos = 0
+        return read > 0
+
+    def peek(self):
+        """ Returns the next non whitespace character, or '' at the end """
+        while True:
+            self._pos = self.whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of {!r}, got {!r}".format(chars, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        """ Reads and decodes the next value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number that runs to the end of the buffer may carry on in the
+            # next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def items(self):
+        """ Iterates over the keys of the next value, which must be an
+        object. Each key's value has to be read before moving on. """
+        self._expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def elements(self):
+        """ Iterates over the next value, which must be an array, in the same
+        way as items. Yields the index of each element. """
+        self._expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        i = 0
+        while True:
+            yield i
+            i += 1
+            if self._expect(',]') == ']':
+                return
+
+
+# Version byte, share scale exponent, user count, entry count
+SLICE_HEADER = struct.Struct("<BBII")
+
+
+def pack_slice(entries, user_ids=None):
+    """
+    Packs a list of (user, shares) tuples into a compact binary layout. The
+    layout is a header, a table of the unique users in the slice, and then
+    fixed width (user index, share count) pairs in the original order. Share
+    counts are stored as integers scaled by the smallest power of ten that
+    makes every share value in the slice whole. The result is zlib compressed
+    at a low level, favoring speed.
+
+    If `user_ids` is given it must map every user to an integer id, which is
+    stored in place of the user table (an interned slice).
+
+    Raises ValueError if a share value can't be represented exactly.
+    """
+    scale = 0
+    for user, shares in entries:
+        exponent = dec(shares).normalize().as_tuple().exponent
+        if not isinstance(exponent, int):
+            raise ValueError("Can't pack share value {}".format(shares))
+        scale = max(scale, -exponent)
+    if scale > 18:
+        raise ValueError("Share values are too precise to pack")
+
+    if user_ids is None:
+        version = 1
+        user_ids = {}
+        table = []
+    else:
+        version = 2
+        table = None
+    ids = []
+    counts = []
+    for user, shares in entries:
+        if table is not None and user not in user_ids:
+            user_ids[user] = len(table)
+            encoded = user.encode('utf8') if isinstance(user, unicode) else user
+            table.append(struct.pack("<H", len(encoded)) + encoded)
+        ids.append(user_ids[user])
+        count = int(dec(shares).scaleb(scale))
+        if count < 0 or count >= 2 ** 64:
+            raise ValueError("Share value {} out of range".format(shares))
+        counts.append(count)
+
+    table = table or []
+    data = (SLICE_HEADER.pack(version, scale, len(table), len(ids)) +
+            "".join(table) +
+            struct.pack("<{}I".format(len(ids)), *ids) +
+            struct.pack("<{}Q".format(len(counts)), *counts))
+    return zlib.compress(data, 1)
+
+
+def encode_entries(entries, encoding, user_ids=None):
+    """ The work of Chain.encode_slice once any users have been interned into
+    `user_ids`. It needs neither the app nor redis, so it can be run in a
+    worker process. Returns the data, the encoding actually used, and the
+    ValueError that made it fall back to bz2json, if one did. """
+    error = None
+    if encoding in ("packed", "interned"):
+        try:
+            return pack_slice(entries, user_ids=user_ids), encoding, None
+        except ValueError as e:
+            error = e
+    elif encoding != "bz2json":
+        raise Exception("Unsupported slice data encoding {}"
+                        .format(encoding))
+
+    data = simplejson.dumps(entries, separators=(',', ':'), use_decimal=True)
+    return bz2.compress(data), "bz2json", error
+
+
+def unpack_slice(data, lookup_users=None):
+    """ Reverses pack_slice, returning a list of (user, Decimal) tuples.
+    Interned slices need `lookup_users`, a callable that takes a set of user
+    ids and returns a mapping of them back to users. """
+    data = zlib.decompress(data)
+    version, scale, user_count, entry_count = SLICE_HEADER.unpack_from(data)
+    if version not in (1, 2):
+        raise ValueError("Unknown packed slice version {}".format(version))
+
+    offset = SLICE_HEADER.size
+    users = []
+    for i in xrange(user_count):
+        length, = struct.unpack_from("<H", data, offset)
+        offset += 2
+        users.append(data[offset:offset + length])
+        offset += length
+
+    ids = struct.unpack_from("<{}I".format(entry_count), data, offset)
+    offset += 4 * entry_count
+    counts = struct.unpack_from("<{}Q".format(entry_count), data, offset)
+
+    if version == 2:
+        if lookup_users is None:
+            raise ValueError("Interned slices require a user lookup")
+        users = lookup_users(set(ids))
+
+    # Most slices share a handful of distinct share values, so only convert
+    # each one once
+    values = {}
+    for count in counts:
+        if count not in values:
+            values[count] = dec(count).scaleb(-scale)
+    return [(users[i], values[count]) for i, count in zip(ids, counts)]
+
+
+# The minute share history behind the worker charts, kept in Redis for the
+# users that have viewed them recently. A hash per user maps each series key
+# to packed timestamp and value columns
+SHARE_HISTORY_KEY = "share_hist_{}"
+# When each cached user last viewed their charts
+SHARE_HISTORY_LRU = "share_hist_lru"
+# Packed size of each cached user's history
+SHARE_HISTORY_SIZE = "share_hist_size"
+# Rough size of the keys and fields a cached user costs besides their history
+SHARE_HISTORY_OVERHEAD = 256
+# How many times an update gets retried after racing another write
+SHARE_HISTORY_RETRIES = 5
+
+
+def pack_history(stamps, values):
+    """ Packs a sorted array('I') of timestamps and an array('d') of values
+    into one string, preceded by their length """
+    return struct.pack("<I", len(stamps)) + stamps.tostring() + values.tostring()
+
+
+def unpack_history(data):
+    """ Reverses pack_history, returning the two arrays """
+    count, = struct.unpack_from("<I", data)
+    stamps = array.array('I')
+    stamps.fromstring(data[4:4 + count * stamps.itemsize])
+    values = array.array('d')
+    values.fromstring(data[4 + count * stamps.itemsize:])
+    return stamps, values
+
+
+def _history_cutoff():
+    """ Timestamp before which minute share history is no longer charted """
+    cfg = ShareSlice.span_config[0]
+    return int(time.time() - (cfg['window'] + cfg['slice'] * 2).total_seconds())
+
+
+def _evict_share_history():
+    """ Drops users that haven't viewed their history in a while, then the
+    least recently viewed ones until the cache is within budget """
+    budget = current_app.config['share_history_budget']
+    idle = time.time() - current_app.config['share_history_idle']
+    sizes = redis_conn.hgetall(SHARE_HISTORY_SIZE)
+    evict = redis_conn.zrangebyscore(SHARE_HISTORY_LRU, '-inf', idle)
+    total = sum(int(size) for size in sizes.itervalues())
+    total -= sum(int(sizes.get(user, 0)) for user in evict)
+    if total > budget:
+        for user in redis_conn.zrange(SHARE_HISTORY_LRU, len(evict), -1):
+            evict.append(user)
+            total -= int(sizes.get(user, 0))
+            if total <= budget:
+                break
+
+    if evict:
+        pipe = redis_conn.pipeline()
+        pipe.delete(*[SHARE_HISTORY_KEY.format(user) for user in evict])
+        pipe.zrem(SHARE_HISTORY_LRU, *evict)
+        pipe.hdel(SHARE_HISTORY_SIZE, *evict)
+        pipe.execute()
+    return len(evict)
+
+
+def _merge_history(loaded, cached):
+    """ Adds the minutes in cached that aren't in loaded to it. Used when a
+    user's history is loaded from the database, since the database has the
+    final value for any minute it has """
+    for key, (stamps, values) in cached.iteritems():
+        loaded_stamps, loaded_values = loaded.setdefault(
+            key, (array.array('I'), array.array('d')))
+        for stamp, value in zip(stamps, values):
+            idx = bisect.bisect_left(loaded_stamps, stamp)
+            if idx == len(loaded_stamps) or loaded_stamps[idx] != stamp:
+                loaded_stamps.insert(idx, stamp)
+                loaded_values.insert(idx, value)
+    return loaded
+
+
+def _update_share_history(users, update):
+    """ Replaces the cached history of each of the given users that is still
+    in SHARE_HISTORY_LRU with update(user, series), where series is
+    {series key: (stamps, values)}. Users left without any history are
+    dropped from the cache. Every eviction and update changes
+    SHARE_HISTORY_SIZE, so watching it makes a write that raced with one
+    start over rather than overwrite it, or recreate an evicted user. After
+    SHARE_HISTORY_RETRIES races the users are dropped instead, to be loaded
+    from the database again when next viewed. Returns the updated
+    histories. """
+    keys = [SHARE_HISTORY_KEY.format(user) for user in users]
+    for _ in xrange(SHARE_HISTORY_RETRIES):
+        with redis_conn.pipeline() as pipe:
+            try:
+                pipe.watch(SHARE_HISTORY_SIZE, *keys)
+                reads = redis_conn.pipeline(transaction=False)
+                for user, key in zip(users, keys):
+                    reads.zscore(SHARE_HISTORY_LRU, user)
+                    reads.hgetall(key)
+                res = reads.execute()
+
+                updates = {}
+                for user, score, series in zip(users, res[::2], res[1::2]):
+                    if score is None:
+                        continue
+                    series = {key: unpack_history(data)
+                              for key, data in series.iteritems()}
+                    updates[user] = update(user, series)
+
+                pipe.multi()
+                for user, series in updates.iteritems():
+                    packed = {key: pack_history(*columns)
+                              for key, columns in series.iteritems()
+                              if len(columns[0])}
+                    pipe.delete(SHARE_HISTORY_KEY.format(user))
+                    if packed:
+                        pipe.hmset(SHARE_HISTORY_KEY.format(user), packed)
+                        size = sum(len(data) for data in packed.itervalues())
+                        pipe.hset(SHARE_HISTORY_SIZE, user,
+                                  size + SHARE_HISTORY_OVERHEAD)
+                    else:
+                        pipe.zrem(SHARE_HISTORY_LRU, user)
+                        pipe.hdel(SHARE_HISTORY_SIZE, user)
+                pipe.execute()
+                return updates
+            except WatchError:
+                continue
+
+    current_app.logger.warn(
+        "Share history update for {:,} users kept racing other writes, "
+        "dropping them from the cache".format(len(users)))
+    pipe = redis_conn.pipeline()
+    pipe.delete(*keys)
+    pipe.zrem(SHARE_HISTORY_LRU, *users)
+    pipe.hdel(SHARE_HISTORY_SIZE, *users)
+    pipe.execute()
+    return {}
+
+
+def append_share_history(slices):
+    """ Adds a list of ShareSlice column value dictionaries to the cached
+    history of any users in it that are cached, dropping history that has
+    aged out of the charts. Returns how many slices were added. """
+    if not current_app.config['share_history_budget']:
+        return 0
+
+    by_user = {}
+    for slc in slices:
+        by_user.setdefault(slc['user'], []).append(slc)
+
+    cutoff = _history_cutoff()
+
+    def append(user, series):
+        for slc in by_user[user]:
+            key = json.dumps([slc['worker'], slc['algo'], slc['share_type']])
+            stamps, values = series.setdefault(
+                key, (array.array('I'), array.array('d')))
+            stamp = calendar.timegm(slc['time'].utctimetuple())
+            # Minutes usually arrive in order, but a late one gets slotted
+            # in, or added to a minute we already have
+            idx = bisect.bisect_left(stamps, stamp)
+            if idx < len(stamps) and stamps[idx] == stamp:
+                values[idx] += slc['value']
+            else:
+                stamps.insert(idx, stamp)
+                values.insert(idx, slc['value'])
+
+        for stamps, values in series.itervalues():
+            trim = bisect.bisect_left(stamps, cutoff)
+            if trim:
+                del stamps[:trim]
+                del values[:trim]
+        return series
+
+    updates = _update_share_history(by_user.keys(), append)
+    return sum(len(by_user[user]) for user in updates)
+
+
+def _history_user(user):
+    """ Whether a user could have share history. Matches the users that
+    collect_minutes writes slices for """
+    if user.startswith("pool"):
+        return True
+    try:
+        return currencies.lookup_payable_addr(user) is not None
+    except InvalidAddressException:
+        return False
+
+
+def share_history(user, worker=None, algo=None, share_type=None,
+                  lower=None, upper=None):
+    """ Serves the minute share history of a list of users from the cache, in
+    the same form as ShareSlice.get_span(grouped=True, stamp=True). Users
+    that aren't cached yet are loaded from the database, and only kept if
+    they have any history. worker, algo and share_type are optional lists to
+    filter by, lower and upper are timestamps. """
+    # Only addresses collect_minutes could have written shares for
+    user = [u for u in user if _history_user(u)]
+    if not user:
+        return []
+    now = time.time()
+    pipe = redis_conn.pipeline()
+    for u in user:
+        pipe.zscore(SHARE_HISTORY_LRU, u)
+        pipe.hgetall(SHARE_HISTORY_KEY.format(u))
+    res = pipe.execute()
+
+    histories = {}
+    missing = []
+    for u, score, series in zip(user, res[::2], res[1::2]):
+        if score is None:
+            missing.append(u)
+        else:
+            histories[u] = {key: unpack_history(data)
+                            for key, data in series.iteritems()}
+
+    # Users are registered before they're loaded so that minutes collected
+    # while the load runs get appended, and merged in below
+    pipe = redis_conn.pipeline()
+    pipe.zadd(SHARE_HISTORY_LRU, **{u: now for u in user})
+    for u in missing:
+        pipe.hsetnx(SHARE_HISTORY_SIZE, u, SHARE_HISTORY_OVERHEAD)
+    pipe.execute()
+
+    if missing:
+        loaded = {u: {} for u in missing}
+        lower_dt = datetime.datetime.utcfromtimestamp(_history_cutoff())
+        for series in ShareSlice.get_span(lower=lower_dt, slice_size=0,
+                                          stamp=True, grouped=True,
+                                          user=missing):
+            d = series['data']
+            stamps = sorted(series['values'])
+            key = json.dumps([d['worker'], d['algo'], d['share_type']])
+            loaded[d['user']][key] = (
+                array.array('I', stamps),
+                array.array('d', [series['values'][s] for s in stamps]))
+        histories.update(loaded)
+        histories.update(_update_share_history(
+            missing, lambda u, series: _merge_history(loaded[u], series)))
+        _evict_share_history()
+
+    result = []
+    for u, series in histories.iteritems():
+        for key, (stamps, values) in series.iteritems():
+            w, a, st = json.loads(key)
+            if ((worker and w not in worker) or (algo and a not in algo) or
+                    (share_type and st not in share_type)):
+                continue
+            start = bisect.bisect_left(stamps, lower) if lower else 0
+            end = bisect.bisect_right(stamps, upper) if upper else len(stamps)
+            if start == end:
+                continue
+            data = OrderedDict([('user', u), ('worker', w), ('algo', a),
+                                ('share_type', st)])
+            result.append({'data': data,
+                           'values': dict(zip(stamps[start:end],
+                                              values[start:end]))})
+    return result
+
+
 def validate_str_perc(perc, round=dec('0.01')):
     """
     Tries to convert a var representing an 0-100 scale percentage into a
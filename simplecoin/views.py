@@ -14,7 +14,8 @@ from .exceptions import InvalidAddressException
 from .utils import (verify_message, collect_user_stats, get_pool_hashrate,
                     get_alerts, resort_recent_visit, CommandException,
                     anon_users, collect_pool_stats, get_past_chain_profit,
-                    orphan_percentage, pool_share_tracker)
+                    orphan_percentage, pool_share_tracker, share_history,
+                    CRON_TASKS)
 
 
 main = Blueprint('main', __name__)
@@ -284,28 +285,34 @@ def address_stats(typ):
                            fmt="both")
     lower, upper, lower_stamp, upper_stamp = res
 
-    workers = cls.get_span(lower=lower,
-                           slice_size=span,
-                           upper=upper,
-                           stamp=True,
-                           **kwargs)
+    # Minute charts for recently viewed users are served from the share
+    # history cache
+    if (typ == "shares" and span == 0 and
+            current_app.config['share_history_budget']):
+        workers = share_history(lower=lower_stamp, upper=upper_stamp, **kwargs)
+    else:
+        workers = cls.get_span(lower=lower,
+                               slice_size=span,
+                               upper=upper,
+                               stamp=True,
+                               grouped=True,
+                               **kwargs)
 
     highest_value = 0
     for worker in workers:
         d = worker['data']
+        values = worker['values']
         # Set the label for this data series
         if typ == "shares":
             d['label'] = "{} ({})".format(d['worker'] or "[unnamed]", d['algo'])
             hps = current_app.config['algos'][d['algo']]['hashes_per_share']
-            for idx in worker['values']:
-                worker['values'][idx] *= hps / step.total_seconds()
-                if worker['values'][idx] > highest_value:
-                    highest_value = worker['values'][idx]
+            factor = hps / step.total_seconds()
+            for idx, value in values.iteritems():
+                values[idx] = value * factor
         else:
             d['label'] = d['device']
-            for idx in worker['values']:
-                if worker['values'][idx] > highest_value:
-                    highest_value = worker['values'][idx]
+        if values:
+            highest_value = max(highest_value, max(values.itervalues()))
 
     if typ == "shares" or kwargs['stat_val'][0] == 0:
         scales = {1000: "KH/s", 1000000: "MH/s", 1000000000: "GH/s"}
@@ -431,10 +438,18 @@ def settings(user_address):
 
 @main.route("/crontabs")
 def crontabs():
-    stats = {}
-    prefix = "cron_last_run_"
-    prefix_len = len(prefix)
-    for key in cache.cache._client.keys("{}*".format(prefix)):
-        stats[key[prefix_len:]] = cache.cache._client.hgetall(key)
+    names = list(cache.cache._client.smembers(CRON_TASKS))
+    pipe = cache.cache._client.pipeline()
+    for name in names:
+        pipe.hgetall("cron_last_run_{}".format(name))
+    # Tasks that haven't run within a day have expired
+    stats = {name: data for name, data in zip(names, pipe.execute()) if data}
+
+    rpc_stats = {}
+    for currency in currencies.itervalues():
+        data = cache.cache._client.hgetall("{}_rpc_stats".format(currency.key))
+        if data:
+            data['latency_avg'] = float(data['latency_total']) / int(data['calls'])
+            rpc_stats[currency.key] = data
 
-    return render_template("crontabs.html", stats=stats)
+    return render_template("crontabs.html", stats=stats, rpc_stats=rpc_stats)